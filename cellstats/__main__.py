@@ -1,5 +1,7 @@
 import argparse
 import os
+import sys
+import time
 
 class bcolors:
     HEADER = '\033[95m'
@@ -25,21 +27,148 @@ def main():
     parser_predict.add_argument('-c', '--channel', required=False, help='Channel to segment. If using CZI files, can be a'\
                                 ' string specifying channel name or an integer specifying channel index. '
                                 'For regular image files: 0 - grayscale, 1 - red, 2 - green, 3 - blue.'
-                                ' In all cases default is 0.', default=0)
+                                ' In all cases default is 0.', default='0')
     parser_predict.add_argument("--gpu", required=False, action="store_true",
                             help="Use gpu acceleration if available")
     parser_predict.add_argument("--features", required=False, nargs='+', default=None,
                                 help="List of features to predict. By default predicts all available features.")
     parser_predict.add_argument("--save_outlines", required=False, action="store_true",
                             help="Save the predicted masks in a folder alongside the output file.")
+    parser_predict.add_argument("--save_masks", "--save-masks", required=False, type=str, default=None, metavar="DIR",
+                                help="Save the label masks to DIR as a .npy file per image, in the smallest integer "\
+                                    "type that fits. They can be memory-mapped to extract features again without "\
+                                    "segmenting, see FeatureExtractor and cellstats.masks.MaskStore.")
+    parser_predict.add_argument("--outline_workers", "--outline-workers", required=False, type=int, default=4,
+                                help="Number of threads drawing and writing outlines. Default is 4.")
+    parser_predict.add_argument("--outline_downscale", "--outline-downscale", required=False, type=int, default=1,
+                                help="Save outlines as previews this many times smaller per side, for quick "\
+                                    "quality control. Default is 1, full size.")
+    parser_predict.add_argument("--outline_compression", "--outline-compression", required=False, type=int,
+                                default=6, choices=range(10), metavar="{0-9}",
+                                help="PNG compression level of outlines. Lower levels are faster to write but "\
+                                    "larger. Default is 6.")
     parser_predict.add_argument("-v" ,"--verbose", required=False, action="store_true",
                             help="Verbose output")
     parser_predict.add_argument("-i", "--intensity_channel", required=False, action='append',
                                 help="Channels to analyze intensity on")
+    parser_predict.add_argument("--intensity_output", "--intensity-output", required=False, default="separate",
+                                choices=["separate", "wide"],
+                                help="Write intensity features to a file per channel (separate, default) or to a "\
+                                    "single table with a column per feature and channel (wide).")
+    parser_predict.add_argument("--incremental", required=False, action="store_true",
+                                help="Only process files that are new or changed since the last incremental run into "\
+                                    "the same output, appending their rows. Processed files are recorded in "\
+                                    "<output_file>.manifest.json after every chunk, so an interrupted run resumes "\
+                                    "where it stopped. fraction_filled thresholds are then computed per chunk.")
+    parser_predict.add_argument("--tile_size", "--tile-size", required=False, type=int, default=None,
+                                help="Process whole-slide images in tiles of this many pixels per side, reading "\
+                                    "only one tile at a time. By default images are processed whole.")
+    parser_predict.add_argument("--tile_overlap", "--tile-overlap", required=False, type=int, default=128,
+                                help="Overlap in pixels between tiles, should be larger than the largest cell. "\
+                                    "Default is 128.")
+    parser_predict.add_argument("--output_format", "--output-format", required=False, default="csv",
+                                choices=["csv", "parquet", "feather"],
+                                help="Format of the feature tables. parquet and feather are written in row groups "\
+                                    "as chunks finish and require pyarrow, output_file should have the format's "\
+                                    "extension. Default is csv.")
+    parser_predict.add_argument("--no_mask_cache", "--no-mask-cache", required=False, action="store_true",
+                                help="Always run segmentation instead of reusing masks cached by previous runs.")
+    parser_predict.add_argument("--mask_cache_size", "--mask-cache-size", required=False, type=int, default=10240,
+                                help="Size cap in MB of the mask cache, enforced after the run. Default is 10240.")
+    parser_predict.add_argument("--chunk_size", "--chunk-size", required=False, type=int, default=None,
+                                help="Process the input in chunks of this many images, appending rows to the output "\
+                                    "as each chunk finishes. Bounds memory use by the chunk size. "\
+                                    "By default all images are processed at once.")
+    parser_predict.add_argument("--io_workers", "--io-workers", required=False, type=int, default=1,
+                                help="Number of threads decoding images. The next chunk is decoded while the "\
+                                    "current one is segmented. Default is 1.")
+    parser_predict.add_argument("--cpu_workers", "--cpu-workers", required=False, type=int, default=0,
+                                help="Number of processes extracting features from segmented chunks. "\
+                                    "Default is 0, extracting features in the main process.")
+    parser_predict.add_argument("--cache_size", "--cache-size", required=False, type=int, default=1024,
+                                help="Memory budget in MB for decoded images shared between segmentation, "\
+                                    "feature extraction and outlines, per process. Default is 1024.")
+    parser_predict.add_argument("--batch_size", "--batch-size", required=False, type=int, default=None,
+                                help="Images of the same shape are segmented together in batches of this size, "\
+                                    "which is also cellpose's batch size. Default is 8.")
+    parser_predict.add_argument("--diameter", required=False, type=float, default=None,
+                                help="Expected cell diameter in pixels, images are rescaled to the model's diameter. "\
+                                    "By default images are not rescaled.")
+    parser_predict.add_argument("--flow_threshold", "--flow-threshold", required=False, type=float, default=None,
+                                help="Maximal flow error of masks. Default is 0.4.")
+    parser_predict.add_argument("--cellprob_threshold", "--cellprob-threshold", required=False, type=float,
+                                default=None, help="Cell probability threshold of mask pixels. Default is 0.")
+    parser_predict.add_argument("--augment", required=False, action="store_true",
+                                help="Average the flows of flipped tiles. Slower, but can be more accurate.")
+    parser_predict.add_argument("--no_resample", "--no-resample", required=False, action="store_true",
+                                help="Compute masks at the rescaled size when using --diameter. Faster, but "\
+                                    "less accurate at the cell borders.")
+    parser_predict.add_argument("--workers", required=False, type=int, default=None,
+                                help="Number of processes running segmentation, each with its own model. Images "\
+                                    "of every chunk are split between them and their masks merged in input order. "\
+                                    "Default is one per device given with --devices, or segmenting in this process.")
+    parser_predict.add_argument("--devices", required=False, nargs='+', default=None,
+                                help="Torch devices the segmentation workers are spread over, e.g. cuda:0 cuda:1, "\
+                                    "or cpu. Workers without a gpu device use the cpu.")
+    parser_predict.add_argument("--progress", required=False, action="store_true",
+                                help="Show a progress bar with the processing rate and the time left. It advances "\
+                                    "as the rows of each chunk are written, see --chunk_size.")
+    parser_predict.add_argument("--profile", required=False, type=str, default=None, metavar="PATH",
+                                help="Record the time of every stage (decoding, segmentation, feature extraction, "\
+                                    "outlines, writing) in all processes and save it to PATH.")
+    parser_predict.add_argument("--profile_format", "--profile-format", required=False, default="json",
+                                choices=["json", "chrome"],
+                                help="json: per-stage totals, counters and all events. chrome: trace events for "\
+                                    "chrome://tracing or Perfetto. Default is json.")
+    parser_predict.add_argument("--server", required=False, nargs="?", const="", default=None, metavar="SOCKET",
+                                help="Send the job to a running 'cellstats serve' daemon, which keeps models loaded, "\
+                                    "instead of running it in this process. Without a path the default socket "\
+                                    "is used.")
             
 
 
     
+    parser_bench = subparsers.add_parser("bench", help="Run benchmarks")
+    subparsers_bench = parser_bench.add_subparsers(help="Benchmarks", dest="bench_command")
+
+    parser_bench_startup = subparsers_bench.add_parser("startup", help="Time the cold start of commands that don't "\
+                                                       "process images, failing if they import heavy dependencies")
+    parser_bench_startup.add_argument("--budget", required=False, type=float, default=300,
+                                      help="Import time budget per command in milliseconds. Default is 300.")
+    parser_bench_startup.add_argument("--repeat", required=False, type=int, default=3,
+                                      help="Number of runs per command, the fastest is reported. Default is 3.")
+
+    parser_bench_stages = subparsers_bench.add_parser("stages", help="Time every processing stage on synthetic "\
+                                                      "images with a stand-in model and report the results as JSON")
+    parser_bench_stages.add_argument("--images", required=False, type=int, default=8,
+                                     help="Number of images. Default is 8.")
+    parser_bench_stages.add_argument("--size", required=False, type=int, nargs=2, default=[1024, 1024],
+                                     metavar=("HEIGHT", "WIDTH"), help="Image size. Default is 1024 1024.")
+    parser_bench_stages.add_argument("--cells", required=False, type=int, default=300,
+                                     help="Number of cells per image. Default is 300.")
+    parser_bench_stages.add_argument("--channels", required=False, type=int, default=3,
+                                     help="Number of channels per image. Default is 3.")
+    parser_bench_stages.add_argument("--repeat", required=False, type=int, default=3,
+                                     help="Number of timed runs per stage, the fastest is reported. Default is 3.")
+    parser_bench_stages.add_argument("--dtype", required=False, default="uint8", choices=["uint8", "uint16"],
+                                     help="Pixel type of the images. Default is uint8.")
+    parser_bench_stages.add_argument("--seed", required=False, type=int, default=0,
+                                     help="Seed of the generated images. Default is 0.")
+    parser_bench_stages.add_argument("--output_formats", "--output-formats", required=False, nargs='+',
+                                     default=["csv"], choices=["csv", "parquet", "feather"],
+                                     help="Output formats to time writing. Default is csv.")
+    parser_bench_stages.add_argument("-o", "--output", required=False, type=str, default=None,
+                                     help="File to write the JSON results to. By default they are printed.")
+
+    parser_serve = subparsers.add_parser("serve", help="Run a daemon that keeps models loaded and runs predict jobs "\
+                                         "sent with predict --server.")
+    parser_serve.add_argument("--socket", required=False, type=str, default=None,
+                              help="Path of the unix socket to listen on. Default is ~/.cellstats/server.sock")
+    parser_serve.add_argument("--preload", required=False, nargs='+', default=None,
+                              help="Models to load before accepting jobs")
+    parser_serve.add_argument("--gpu", required=False, action="store_true",
+                              help="Load preloaded models on the gpu")
+
     parser_model = subparsers.add_parser("model", help="manage cellpose models")
     subparsers_model = parser_model.add_subparsers(help="Functions", dest="model_command")
 
@@ -67,6 +196,25 @@ def main():
 
 
     parser_model_ls = subparsers_model.add_parser("ls", help="List available models")
+    parser_model_ls.add_argument("-l", "--long", required=False, action="store_true",
+                            help="Show the size, hash and time added of every model")
+
+    parser_model_reindex = subparsers_model.add_parser("reindex", help="Rebuild the index of a model repository "\
+                                                       "from its files, for models copied in without 'model add'")
+    parser_model_reindex.add_argument("-e", "--env", "--environment", required=False, action="store_true",
+                            help="Use the environment-wide model repository, if initialized")
+
+
+    parser_cache = subparsers.add_parser("cache", help="manage the cache of predicted masks")
+    subparsers_cache = parser_cache.add_subparsers(help="Functions", dest="cache_command")
+
+    parser_cache_ls = subparsers_cache.add_parser("ls", help="Show the cached masks")
+    parser_cache_ls.add_argument("-a", "--all", required=False, action="store_true",
+                            help="List every cached mask, most recently used first")
+
+    parser_cache_prune = subparsers_cache.add_parser("prune", help="Remove least recently used masks")
+    parser_cache_prune.add_argument("--max_size", "--max-size", required=False, type=int, default=10240,
+                            help="Size in MB to shrink the cache to. 0 empties it. Default is 10240.")
 
     args = parser.parse_args()
     
@@ -80,9 +228,21 @@ def main():
         elif args.model_command == "remove":
             models.remove_model(args.name, args.env)
             
+        elif args.model_command == "reindex":
+            print(f"Indexed {len(models.reindex(args.env))} models")
+
         elif args.model_command == "ls":
             mdls = models.list_models()
             separator = '\n  - '
+            if args.long:
+                from cellstats.cache import format_size
+                def describe(environment):
+                    entries = models.model_entries(environment)
+                    width = max((len(e.name) for e in entries), default=0)
+                    return [f"{e.name:<{width}}  {format_size(e.size):>10}  {e.sha256[:12]}  "\
+                            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(e.added))}" for e in entries]
+                mdls = {"environment": describe(True) if models.environment_repository_initialized() else [],
+                        "local": describe(False)}
             env_models = separator.join(mdls["environment"])
             local_models = separator.join(mdls["local"])
 
@@ -95,29 +255,85 @@ def main():
                 local_models = separator + local_models
             print(f"Environment:{env_models}\nLocal:{local_models}")
 
+    elif args.command == "cache":
+        from cellstats import cache
+        mask_cache = cache.MaskCache()
+        if args.cache_command == "ls":
+            entries = sorted(mask_cache.entries(), key=lambda e: e.last_used, reverse=True)
+            print(f"{mask_cache.cache_dir}: {len(entries)} masks, {cache.format_size(sum(e.size for e in entries))}")
+            if args.all:
+                for e in entries:
+                    last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(e.last_used))
+                    print(f"  {e.key}  {cache.format_size(e.size):>10}  {last_used}")
+        elif args.cache_command == "prune":
+            removed, freed = mask_cache.prune(args.max_size * 1024 ** 2)
+            print(f"Removed {removed} masks, freed {cache.format_size(freed)}")
+
+    elif args.command == "bench":
+        if args.bench_command == "startup":
+            from cellstats.benchmarks import startup
+            if not startup.run(args.budget, args.repeat):
+                sys.exit(1)
+        elif args.bench_command == "stages":
+            from cellstats.benchmarks import stages
+            stages.main(args.output, images=args.images, shape=tuple(args.size), cells=args.cells,
+                        channels=args.channels, repeat=args.repeat, seed=args.seed, dtype=args.dtype,
+                        output_formats=args.output_formats)
+
+    elif args.command == "serve":
+        from cellstats import server
+        server.serve(args.socket, args.preload, args.gpu)
+
     elif args.command == "predict":
-        from cellstats import models
-        from cellstats import post_processing
-        from cellstats import io
         if args.save_outlines:
             outdir = os.path.join(os.path.dirname(os.path.abspath(args.output_file)), "segmentation_outlines")
         else:
             outdir = None
         channel = int(args.channel) if args.channel.isdigit() else args.channel
-        masks, image_names = models.predict_masks(args.input_file, args.model, args.gpu, channel,
-                                    args.verbose, None, return_image_names=True)
-        if outdir is not None:
-            io.save_image_outlines(args.input_file, outdir, masks, channel, verbose=True)
-        fe = post_processing.FeatureExtractor(masks, files=image_names, scales=io.load_image_scales(args.input_file))
-        df = fe.get_geometrical_features(args.features)
-        df.to_csv(args.output_file, index=False)
+        intensity_channels = None
         if args.intensity_channel is not None:
-            for ic in args.intensity_channel:
-                if ic.isdigit():
-                    ic = int(ic)
-                out_file_name = f"{os.path.splitext(args.output_file)[0]}_intensity_{ic}.csv"
-                fe.get_intensity_features(ic, None).to_csv(out_file_name, index=False)
-
+            intensity_channels = [int(ic) if ic.isdigit() else ic for ic in args.intensity_channel]
+        if args.tile_size is not None and (outdir is not None or args.incremental or args.save_masks):
+            parser.error("--tile_size can not be combined with --save_outlines, --save_masks or --incremental")
+        if args.outline_downscale < 1:
+            parser.error("--outline_downscale should be at least 1")
+        if args.tile_size is not None and (args.workers or args.devices):
+            parser.error("--tile_size can not be combined with --workers or --devices")
+        eval_params = {"batch_size": args.batch_size, "diameter": args.diameter,
+                       "flow_threshold": args.flow_threshold, "cellprob_threshold": args.cellprob_threshold}
+        eval_params = {k: v for k, v in eval_params.items() if v is not None}
+        if args.augment:
+            eval_params["augment"] = True
+        if args.no_resample:
+            eval_params["resample"] = False
+        job = {"input_file": args.input_file, "output_file": args.output_file,
+               "model": args.model, "channel": channel, "gpu": args.gpu, "features": args.features,
+               "intensity_channels": intensity_channels, "outline_dir": outdir, "verbose": args.verbose,
+               "tile_size": args.tile_size, "tile_overlap": args.tile_overlap, "chunk_size": args.chunk_size,
+               "io_workers": args.io_workers, "cpu_workers": args.cpu_workers,
+               "cache_size": args.cache_size * 1024 ** 2, "intensity_output": args.intensity_output,
+               "incremental": args.incremental, "output_format": args.output_format,
+               "workers": args.workers or 0, "devices": args.devices, "eval_params": eval_params,
+               "outline_workers": args.outline_workers, "outline_downscale": args.outline_downscale,
+               "outline_compression": args.outline_compression,
+               "mask_dir": args.save_masks or None,
+               "progress": args.progress, "profile_format": args.profile_format, "profile": args.profile or None,
+               "mask_cache": not args.no_mask_cache, "mask_cache_size": args.mask_cache_size * 1024 ** 2}
+        if args.server is not None:
+            # The daemon runs in its own working directory, so it gets absolute paths. The source of a single
+            # input file is then its absolute path, locally it stays the path as given.
+            for key in ("input_file", "output_file", "mask_dir", "profile"):
+                if job[key] is not None:
+                    job[key] = os.path.abspath(job[key])
+            if job["model"] is not None and os.path.isfile(job["model"]):
+                job["model"] = os.path.abspath(job["model"])
+            # Only the standard library is needed to hand the job over
+            from cellstats import server
+            if not server.submit(args.server or None, job):
+                sys.exit(1)
+        else:
+            from cellstats import pipeline
+            pipeline.run_job(job)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import json
+import platform
+import tempfile
+import tracemalloc
+import warnings
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from cellstats import io
+from cellstats import models
+from cellstats.benchmarks import synthetic
+from cellstats.output import open_writer
+from cellstats.post_processing import FeatureExtractor
+
+
+class ThresholdModel:
+    """
+    Stands in for a cellpose model: cells are the connected components above the mean intensity of
+    each image. Takes and returns the same shapes as CellposeModel.eval.
+    """
+
+    def eval(self, x, **kwargs):
+        from scipy import ndimage
+        batch = [x] if isinstance(x, np.ndarray) and x.ndim < 4 else list(x)
+        masks = []
+        for img in batch:
+            img = img[..., 0] if img.ndim == 3 else img
+            masks.append(ndimage.label(img > img.mean())[0].astype(np.int32))
+        if isinstance(x, list):
+            return masks, None, None
+        return np.stack(masks).squeeze(), None, None
+
+
+def _max_rss() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _measure(fn: Callable, repeat: int) -> Tuple[float, int, object]:
+    # The fastest of the timed runs, and the peak of traced allocations of a separate run since
+    # tracing slows down allocations
+    seconds, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, result
+
+
+def run(images: int = 8, shape: Tuple[int, int] = (1024, 1024), cells: int = 300, channels: int = 3,
+        repeat: int = 3, seed: int = 0, output_formats: Optional[List[str]] = None, dtype: str = "uint8") -> dict:
+    """
+    Times every stage of processing a synthetic dataset, written as TIFF files with ZEN metadata,
+    and returns throughput and peak memory of each stage.
+    """
+    if output_formats is None:
+        output_formats = ["csv"]
+    stages: Dict[str, dict] = {}
+    intensity_channels = list(range(channels))
+
+    def record(name: str, fn: Callable, cells_count: Optional[int] = None, nbytes: Optional[int] = None):
+        try:
+            seconds, peak, result = _measure(fn, repeat)
+        except Exception as e:
+            # A stage failing in one version shouldn't keep the others from being compared
+            stages[name] = {"error": f"{type(e).__name__}: {e}"}
+            return None
+        stage = {"seconds": seconds, "images_per_second": images / seconds, "peak_bytes": peak}
+        if cells_count is not None:
+            stage["cells_per_second"] = cells_count / seconds
+        if nbytes is not None:
+            stage["megabytes_per_second"] = nbytes / seconds / 1024 ** 2
+        stages[name] = stage
+        return result
+
+    with tempfile.TemporaryDirectory(prefix="cellstats_bench_") as directory, warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        input_dir = os.path.join(directory, "input")
+        start = time.perf_counter()
+        synthetic.write_dataset(input_dir, images, shape, cells, channels, seed, np.dtype(dtype))
+        generate_seconds = time.perf_counter() - start
+        paths, _ = io.list_images(input_dir)
+        nbytes = sum(os.path.getsize(p) for p in paths)
+
+        decoded = record("decode", lambda: [io.read_image(p) for p in paths], nbytes=nbytes)
+        seg_images = [io.extract_channel(p, img, 1) for p, img in zip(paths, decoded)]
+        model = ThresholdModel()
+        masks = record("segment", lambda: models.segment(model, seg_images))
+        total_cells = int(sum(m.max() for m in masks))
+        scales = io.load_run_scales(paths)
+
+        def geometry():
+            return FeatureExtractor(masks, files=paths, scales=scales).get_geometrical_features(None)
+
+        def intensity():
+            fe = FeatureExtractor(masks, files=paths, scales=scales, intensity_channels=intensity_channels,
+                                  images=decoded)
+            return fe.get_intensity_features(intensity_channels, None)
+
+        geometry_df = record("geometry", geometry, total_cells)
+        intensity_df = record("intensity", intensity, total_cells)
+
+        outline_dir = os.path.join(directory, "outlines")
+        os.makedirs(outline_dir)
+        record("outlines", lambda: [io.save_image_outline(p, outline_dir, m, 1, image=img)
+                                    for p, img, m in zip(paths, decoded, masks)])
+
+        for output_format in output_formats:
+            def write(output_format=output_format):
+                for name, df in [("geometry", geometry_df), ("intensity", intensity_df)]:
+                    writer = open_writer(os.path.join(directory, f"{name}.{output_format}"), output_format)
+                    writer.write(df)
+                    writer.close()
+            record(f"write_{output_format}", write, total_cells)
+
+    return {
+        "config": {"images": images, "shape": list(shape), "cells_per_image": cells, "channels": channels,
+                   "dtype": dtype, "repeat": repeat, "seed": seed},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "cells": total_cells,
+        "generate_seconds": generate_seconds,
+        "stages": stages,
+        "max_rss_bytes": _max_rss(),
+    }
+
+
+def main(output_path: Optional[str] = None, **kwargs) -> dict:
+    results = run(**kwargs)
+    text = json.dumps(results, indent=2)
+    if output_path is None:
+        print(text)
+    else:
+        with open(output_path, "w") as f:
+            f.write(text)
+    return results
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from typing import Dict, List, NamedTuple
+
+# Importing any of these costs seconds, commands that don't process images must not import them
+HEAVY_MODULES = ("cellpose", "torch", "aicsimageio", "matplotlib", "skimage", "scipy", "pandas", "lxml")
+DEFAULT_BUDGET_MS = 300
+
+
+class StartupResult(NamedTuple):
+    command: str
+    wall_ms: float
+    import_ms: float
+    heavy_modules: List[str]
+
+
+def parse_importtime(stderr: str) -> Dict[str, int]:
+    """
+    Cumulative import time in microseconds of every top-level import in python -X importtime output.
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def imported_modules(stderr: str) -> List[str]:
+    return [line.split("|")[-1].strip() for line in stderr.splitlines() if line.startswith("import time:")]
+
+
+def measure(args: List[str], env: Dict[str, str]) -> StartupResult:
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-m", "cellstats", *args], env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        errors = "\n".join(l for l in proc.stderr.splitlines() if not l.startswith("import time:"))
+        raise RuntimeError(f"cellstats {' '.join(args)} failed:\n{errors}")
+    heavy = sorted({m.split(".")[0] for m in imported_modules(proc.stderr)} & set(HEAVY_MODULES))
+    return StartupResult(" ".join(args), wall_ms, sum(parse_importtime(proc.stderr).values()) / 1000, heavy)
+
+
+def run(budget_ms: float = DEFAULT_BUDGET_MS, repeat: int = 3) -> bool:
+    """
+    Times the cold start of the commands that don't process images, each with a fresh interpreter and
+    against an empty home directory. Returns whether all of them stayed within the import time budget
+    without importing any of the heavy modules.
+    """
+    ok = True
+    with tempfile.TemporaryDirectory(prefix="cellstats_bench_") as home:
+        env = {**os.environ, "HOME": home, "USERPROFILE": home}
+        env.pop("CELLSTATS_ENVIRONMENT_MODEL_REPOSITORY", None)
+        model_file = os.path.join(home, "model.bin")
+        with open(model_file, "wb") as f:
+            f.write(b"\0" * 1024)
+        commands = [["--help"], ["predict", "--help"], ["model", "add", model_file, "-n", "bench"],
+                    ["model", "rename", "bench", "bench2"], ["model", "ls"], ["model", "remove", "bench2"],
+                    ["cache", "ls"]]
+        # The model commands leave the repository as it was, so the sequence can be repeated
+        results = [[measure(args, env) for args in commands] for _ in range(repeat)]
+        print(f"{'command':<40}{'wall ms':>10}{'import ms':>12}")
+        for args, runs in zip(commands, zip(*results)):
+            # The fastest run is the least disturbed by other processes
+            best = min(runs, key=lambda r: r.import_ms)
+            label = " ".join(a if a != model_file else "<model>" for a in args)
+            status = ""
+            if best.heavy_modules:
+                status = f"  imports {', '.join(best.heavy_modules)}"
+            elif best.import_ms > budget_ms:
+                status = f"  over budget of {budget_ms:.0f} ms"
+            ok = ok and not status
+            print(f"{label:<40}{min(r.wall_ms for r in runs):>10.0f}{best.import_ms:>12.0f}{status}")
+    return ok
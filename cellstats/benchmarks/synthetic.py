@@ -0,0 +1,121 @@
+import os
+from typing import List, Optional, Tuple
+import numpy as np
+
+# Zeiss ZEN style metadata, as exported next to .tif files and embedded in .czi files
+_METADATA_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<ImageDocument>
+  <Metadata>
+    <Information>
+      <Image>
+        <SizeX>{size_x}</SizeX>
+        <SizeY>{size_y}</SizeY>
+        <SizeC>{size_c}</SizeC>
+        <Dimensions>
+          <Channels>
+{channels}
+          </Channels>
+        </Dimensions>
+      </Image>
+    </Information>
+    <Scaling>
+      <Items>
+        <Distance Id="X">
+          <Value>{scale}</Value>
+        </Distance>
+        <Distance Id="Y">
+          <Value>{scale}</Value>
+        </Distance>
+      </Items>
+    </Scaling>
+  </Metadata>
+</ImageDocument>
+"""
+_CHANNEL_TEMPLATE = """            <Channel Id="Channel:{index}" Name="{name}">
+              <Color>{color}</Color>
+            </Channel>"""
+_CHANNEL_COLORS = ["#FF0000FF", "#FF00FF00", "#FFFF0000", "#FFFFFF00", "#FFFF00FF", "#FF00FFFF"]
+
+
+class SyntheticImage:
+    """
+    A label image of elliptical cells and a matching multi-channel intensity image.
+    """
+
+    def __init__(self, labels: np.ndarray, image: np.ndarray) -> None:
+        self.labels = labels
+        self.image = image
+
+
+def make_labels(shape: Tuple[int, int], cells: int, rng: np.random.Generator,
+                min_radius: int = 6, max_radius: int = 18) -> np.ndarray:
+    """
+    Randomly placed and oriented ellipses, later cells are drawn over earlier ones.
+    """
+    labels = np.zeros(shape, dtype=np.int32)
+    for label in range(1, cells + 1):
+        a, b = rng.uniform(min_radius, max_radius, 2)
+        cy, cx = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+        theta = rng.uniform(0, np.pi)
+        r = int(np.ceil(max(a, b)))
+        y0, y1 = max(int(cy) - r, 0), min(int(cy) + r + 1, shape[0])
+        x0, x1 = max(int(cx) - r, 0), min(int(cx) + r + 1, shape[1])
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        dy, dx = yy - cy, xx - cx
+        u = dx * np.cos(theta) + dy * np.sin(theta)
+        v = -dx * np.sin(theta) + dy * np.cos(theta)
+        inside = (u / a) ** 2 + (v / b) ** 2 <= 1
+        labels[y0:y1, x0:x1][inside] = label
+    return labels
+
+
+def make_intensity(labels: np.ndarray, channels: int, rng: np.random.Generator,
+                   dtype=np.uint16) -> np.ndarray:
+    """
+    YXC image with a brightness per cell and channel, an intensity gradient across every cell, so
+    centers of mass differ from centroids, and noisy background.
+    """
+    max_value = np.iinfo(dtype).max
+    n = labels.max()
+    image = np.empty(labels.shape + (channels,), dtype=dtype)
+    yy, xx = np.mgrid[:labels.shape[0], :labels.shape[1]]
+    for c in range(channels):
+        brightness = np.concatenate([[0], rng.uniform(0.2, 0.8, n)]) * max_value
+        gradient = 1 + 0.3 * np.sin(yy / rng.uniform(5, 15) + xx / rng.uniform(5, 15))
+        background = rng.normal(0.05 * max_value, 0.01 * max_value, labels.shape)
+        values = brightness[labels] * gradient + background
+        image[:, :, c] = np.clip(values, 0, max_value).astype(dtype)
+    return image
+
+
+def make_image(shape: Tuple[int, int], cells: int, channels: int, rng: np.random.Generator,
+               dtype=np.uint16) -> SyntheticImage:
+    labels = make_labels(shape, cells, rng)
+    return SyntheticImage(labels, make_intensity(labels, channels, rng, dtype))
+
+
+def metadata_xml(shape: Tuple[int, int], channels: int, scale: float = 1.6e-7) -> str:
+    channel_xml = "\n".join(_CHANNEL_TEMPLATE.format(index=c, name=f"C{c}",
+                                                     color=_CHANNEL_COLORS[c % len(_CHANNEL_COLORS)])
+                            for c in range(channels))
+    return _METADATA_TEMPLATE.format(size_x=shape[1], size_y=shape[0], size_c=channels, channels=channel_xml,
+                                     scale=scale)
+
+
+def write_dataset(directory: str, images: int, shape: Tuple[int, int], cells: int, channels: int,
+                  seed: Optional[int] = 0, dtype=np.uint16) -> List[SyntheticImage]:
+    """
+    Writes images as well{i}_img.tif, each with a well{i}.tif_metadata.xml metadata file as found next
+    to images exported from ZEN, and returns the generated images.
+    """
+    import tifffile
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dataset = []
+    for i in range(images):
+        synthetic = make_image(shape, cells, channels, rng, dtype)
+        tifffile.imwrite(os.path.join(directory, f"well{i}_img.tif"), synthetic.image)
+        with open(os.path.join(directory, f"well{i}.tif_metadata.xml"), "w") as f:
+            f.write(metadata_xml(shape, channels))
+        dataset.append(synthetic)
+    return dataset
@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import pathlib
+import tempfile
+import zipfile
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+
+_MASK_CACHE_DIR_ENV = os.environ.get("CELLSTATS_MASK_CACHE")
+_MASK_CACHE_DIR_DEFAULT = pathlib.Path.home().joinpath('.cellstats', 'masks')
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+
+_file_digests: Dict[Tuple[str, int, int], str] = {}
+
+
+def file_digest(path: str) -> str:
+    # Memoized per process by path, size and modification time
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_digests:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 ** 2), b""):
+                h.update(block)
+        _file_digests[memo_key] = h.hexdigest()
+    return _file_digests[memo_key]
+
+
+class CacheEntry(NamedTuple):
+    key: str
+    size: int
+    last_used: float
+
+
+class MaskCache:
+    """
+    Content-addressed store of segmentation masks. A mask is keyed by the image it was predicted from,
+    the segmented channel, the model weights and the evaluation parameters, and stored as a compressed
+    .npz file. The modification time of an entry is its last use, which pruning goes by.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None) -> None:
+        if cache_dir is None:
+            cache_dir = _MASK_CACHE_DIR_ENV if _MASK_CACHE_DIR_ENV else _MASK_CACHE_DIR_DEFAULT
+        self.cache_dir = pathlib.Path(cache_dir)
+
+
+    @staticmethod
+    def key(image: np.ndarray, channel, model_digest: str, eval_params: dict) -> str:
+        h = hashlib.sha256()
+        image = np.ascontiguousarray(image)
+        h.update(f"{image.dtype.str}{image.shape}".encode())
+        h.update(memoryview(image).cast("B"))
+        h.update(json.dumps({"channel": channel, "model": model_digest, "eval": eval_params},
+                            sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+
+    def __path(self, key: str) -> pathlib.Path:
+        return self.cache_dir.joinpath(key[:2], f"{key}.npz")
+
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self.__path(key)
+        try:
+            with np.load(path) as data:
+                mask = data["mask"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Partially written or corrupt entry, predict it again
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)
+        return mask
+
+
+    def put(self, key: str, mask: np.ndarray) -> None:
+        path = self.__path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, mask=mask)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+    def entries(self) -> List[CacheEntry]:
+        if not self.cache_dir.is_dir():
+            return []
+        entries = []
+        for path in self.cache_dir.glob("*/*.npz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append(CacheEntry(path.stem, stat.st_size, stat.st_mtime))
+        return entries
+
+
+    def size(self) -> int:
+        return sum(e.size for e in self.entries())
+
+
+    def prune(self, max_size: int = DEFAULT_MAX_SIZE) -> Tuple[int, int]:
+        """
+        Removes least recently used masks until the cache is at most max_size bytes.
+        Returns the number of removed entries and the number of freed bytes.
+        """
+        entries = sorted(self.entries(), key=lambda e: e.last_used)
+        total = sum(e.size for e in entries)
+        removed, freed = 0, 0
+        for entry in entries:
+            if total - freed <= max_size:
+                break
+            self.__path(entry.key).unlink(missing_ok=True)
+            removed += 1
+            freed += entry.size
+        return removed, freed
+
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
@@ -1,32 +1,138 @@
 import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Optional, Union
 import numpy as np
-from cellpose import io as cpio
 import xml.etree.ElementTree as ET
-from aicsimageio import AICSImage
-from PIL import Image
-from cellpose.utils import masks_to_outlines
-from matplotlib import colors
-from skimage import color
+from cellstats import profiling
+
+# cellpose, aicsimageio, matplotlib and skimage take seconds to import, so they are only imported
+# by the functions that use them
 
 
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff"}
+METADATA_SUFFIX = ".tif_metadata.xml"
 
-def load_images(input_path: str, channel=0, rgb=False, czi_all_channels=False):
+
+class ImageCache:
+    """
+    LRU cache of decoded images and parsed metadata, keyed by file path.
+    Images are stored as decoded from disk (all channels) and evicted once their total size exceeds
+    max_bytes. None means no limit.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None, max_metadata: int = 1024) -> None:
+        self.max_bytes = max_bytes
+        self.max_metadata = max_metadata
+        self.nbytes = 0
+        self.__images: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.__metadata: OrderedDict = OrderedDict()
+        self.__lock = threading.Lock()
+
+
+    def get_image(self, img_path: str) -> np.ndarray:
+        key = os.path.abspath(img_path)
+        with self.__lock:
+            if key in self.__images:
+                self.__images.move_to_end(key)
+                profiling.count("image_cache_hits")
+                return self.__images[key]
+        profiling.count("image_cache_misses")
+        img, metadata = _read_image(img_path)
+        self.put_image(img_path, img)
+        if metadata is not None:
+            self.put_metadata(img_path, metadata)
+        return img
+
+
+    def put_image(self, img_path: str, img: np.ndarray) -> None:
+        if self.max_bytes is not None and img.nbytes > self.max_bytes:
+            return
+        key = os.path.abspath(img_path)
+        with self.__lock:
+            if key in self.__images:
+                self.nbytes -= self.__images.pop(key).nbytes
+            self.__images[key] = img
+            self.nbytes += img.nbytes
+            while self.max_bytes is not None and self.nbytes > self.max_bytes:
+                _, evicted = self.__images.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+
+    def get_metadata(self, metadata_path: str):
+        key = os.path.abspath(metadata_path)
+        with self.__lock:
+            if key in self.__metadata:
+                self.__metadata.move_to_end(key)
+                return self.__metadata[key]
+        metadata = _read_metadata(metadata_path)
+        self.put_metadata(metadata_path, metadata)
+        return metadata
+
+
+    def put_metadata(self, metadata_path: str, metadata) -> None:
+        key = os.path.abspath(metadata_path)
+        with self.__lock:
+            self.__metadata[key] = metadata
+            self.__metadata.move_to_end(key)
+            while len(self.__metadata) > self.max_metadata:
+                self.__metadata.popitem(last=False)
+
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__images.clear()
+            self.__metadata.clear()
+            self.nbytes = 0
+
+
+_image_cache: Optional[ImageCache] = None
+
+
+def get_image_cache() -> Optional[ImageCache]:
+    return _image_cache
+
+
+def set_image_cache(cache: Optional[ImageCache]) -> Optional[ImageCache]:
+    global _image_cache
+    previous = _image_cache
+    _image_cache = cache
+    return previous
+
+
+@contextmanager
+def image_cache(max_bytes: Optional[int] = None):
+    cache = ImageCache(max_bytes)
+    previous = set_image_cache(cache)
+    try:
+        yield cache
+    finally:
+        set_image_cache(previous)
+
+
+def list_images(input_path: str):
     if os.path.isdir(input_path):
-        image_names = []
-        images = []
-        for im in os.listdir(input_path):
-            if is_image_file(im) or im.endswith(".czi"):
-                images.append(load_image(os.path.join(input_path, im), channel, rgb))
-                image_names.append(im)
+        image_names = [im for im in os.listdir(input_path) if is_image_file(im) or im.endswith(".czi")]
+        image_paths = [os.path.join(input_path, im) for im in image_names]
 
     elif os.path.isfile(input_path):
         image_names = [input_path]
-        images = [load_image(input_path, channel, rgb, czi_all_channels)]
+        image_paths = [input_path]
 
     else:
         raise FileNotFoundError(f"Could not find {input_path}")
 
+    return image_paths, image_names
+
+
+def load_images(input_path: str, channel=0, rgb=False, czi_all_channels=False):
+    image_paths, image_names = list_images(input_path)
+    if os.path.isdir(input_path):
+        images = [load_image(p, channel, rgb) for p in image_paths]
+    else:
+        images = [load_image(input_path, channel, rgb, czi_all_channels)]
+
     return images, image_names
 
 
@@ -34,82 +140,233 @@ def load_metadata(input_path: str, metadata_suffix: str):
     metadata=[]
     if os.path.isdir(input_path):
         for f in os.listdir(input_path):
-            if f.endswith(metadata_suffix):
-                metadata.append(ET.parse(f))
-            elif f.endswith(".czi"):
-                metadata.append(AICSImage(f).metadata)
+            if f.endswith(metadata_suffix) or f.endswith(".czi"):
+                metadata.append(_get_metadata(os.path.join(input_path, f)))
     
-    elif os.path.isfile(input_path) and input_path.endswith(".czi"):
-        metadata = [AICSImage(input_path).metadata]
-
-    elif os.path.isfile(input_path) and input_path.endswith(".xml"):
-        metadata = [ET.parse(input_path)]
+    elif os.path.isfile(input_path) and (input_path.endswith(".czi") or input_path.endswith(".xml")):
+        metadata = [_get_metadata(input_path)]
 
     elif os.path.isfile(input_path) and not input_path.endswith(".xml"):
-        metadata = [ET.parse(input_path[:input_path.rfind("_")] + metadata_suffix)]
+        metadata = [_get_metadata(metadata_path(input_path, metadata_suffix))]
     
     return metadata
 
 
-def load_image_scales(input_path: str):
-    metadata = load_metadata(input_path, ".tif_metadata.xml")
+def metadata_path(img_path: str, metadata_suffix: str = METADATA_SUFFIX) -> str:
+    if img_path.endswith(".czi") or img_path.endswith(".xml"):
+        return img_path
+    return img_path[:img_path.rfind("_")] + metadata_suffix
+
+
+def _get_metadata(metadata_path: str):
+    if _image_cache is not None:
+        return _image_cache.get_metadata(metadata_path)
+    return _read_metadata(metadata_path)
+
+
+def _read_metadata(metadata_path: str):
+    if metadata_path.endswith(".czi"):
+        from aicsimageio import AICSImage
+        return AICSImage(metadata_path).metadata
+    return ET.parse(metadata_path)
+
+
+def load_image_scales(input_path: Union[str, List[str]]):
+    if isinstance(input_path, (list, tuple)):
+        # Per-file metadata, in the order of the given files. Raises FileNotFoundError if a file has none,
+        # see load_run_scales
+        metadata = []
+        for img_path in input_path:
+            metadata.extend(load_metadata(img_path, METADATA_SUFFIX))
+    else:
+        metadata = load_metadata(input_path, METADATA_SUFFIX)
     return np.array([float(m.find(".//Scaling/Items/Distance/Value").text) for m in metadata])
 
 
-def save_image_outlines(input_path: str, output_path: str, masks: np.ndarray, channel=0, color="r", verbose=False):
+def load_run_scales(image_paths: List[str]) -> np.ndarray:
+    """
+    Scales of all images of a run, in their order. A run's features are either all in physical units or all
+    in pixels: without metadata for any of the images the result is empty, and if only some have metadata
+    FileNotFoundError is raised.
+    """
+    scales, missing = [], []
+    for img_path in image_paths:
+        try:
+            scales.extend(load_image_scales([img_path]))
+        except FileNotFoundError:
+            missing.append(img_path)
+    if not missing:
+        return np.array(scales)
+    if len(missing) < len(image_paths):
+        raise FileNotFoundError(f"Metadata of {len(missing)} of {len(image_paths)} images was not found, "\
+                                f"e.g. {metadata_path(missing[0])}. Without it features of those images would "\
+                                "be in pixels and of the others in physical units.")
+    return np.array([])
+
+
+# PIL's default, lower levels write faster and larger files
+DEFAULT_OUTLINE_COMPRESSION = 6
+
+
+def save_image_outlines(input_path: str, output_path: str, masks: np.ndarray, channel=0, color="r", verbose=False,
+                        workers: int = 4, downscale: int = 1, compress_level: int = DEFAULT_OUTLINE_COMPRESSION):
+    """
+    Renders and writes the outlines of all images, on a pool of threads. Image decoding, rendering and
+    PNG encoding release the GIL.
+    """
+    from concurrent.futures import ThreadPoolExecutor
     if verbose:
         print(f"Saving masks to {output_path}. This might take a while...")
-    input_images, input_image_names = load_images(input_path, rgb=True)
-    metadata = load_metadata(input_path, ".tif_metadata.xml")
-    for i in range(len(input_images)):
-        mask = masks[i]
-        image_name, image_ext = os.path.splitext(os.path.basename(input_image_names[i]))
-        if image_ext == ".czi":
-            channels_info = metadata[i].find(".//Information/Image/Dimensions/Channels")
-            if isinstance(channel, str):
-                c = channels_info.find(f'.//Channel[@Name="{channel}"]/Color').text
-            elif isinstance(channel, int):
-                c = channels_info.findall('.//Channel/Color')[channel].text
-            else:
-                c = channels_info.find('.//Channel/Color').text
-            
-            c = np.array(colors.to_rgb(f"#{c[3:]}")).reshape((3,1,1))
-            image = input_images[i].copy()
-            im_max = np.max(image)
-            im_min = np.min(image)
-            image = (image - im_min) / (im_max - im_min)
-            image = (image * c).transpose(1,2,0)
-            image = (image * 255).astype(np.uint8)
-        elif image_ext in IMAGE_EXTENSIONS:
-            image = input_images[i].copy()
-
-        outline = masks_to_outlines(mask)
-        image[outline] = (np.array(colors.to_rgb(color)) * 255).astype(np.uint8)
-
-        Image.fromarray(image).save(f"{os.path.join(output_path, image_name)}_outlines.png")
-        if verbose:
-            print(f"Saved outline for {image_name}")
+    input_image_paths, _ = list_images(input_path)
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        futures = [pool.submit(save_image_outline, p, output_path, mask, channel, color,
+                               downscale=downscale, compress_level=compress_level)
+                   for p, mask in zip(input_image_paths, masks)]
+        for p, future in zip(input_image_paths, futures):
+            future.result()
+            if verbose:
+                print(f"Saved outline for {os.path.splitext(os.path.basename(p))[0]}")
+
+
+def save_image_outline(img_path: str, output_path: str, mask: np.ndarray, channel=0, color="r",
+                       image: Optional[np.ndarray] = None, metadata=None, downscale: int = 1,
+                       compress_level: int = DEFAULT_OUTLINE_COMPRESSION) -> str:
+    """
+    Writes the image with the outlines of the mask drawn over it as <image name>_outlines.png and returns
+    its path. image and metadata are read when not given, image as decoded by read_image. With
+    downscale, a preview that is smaller by this factor per side is written instead.
+    """
+    from PIL import Image
+    with profiling.stage("outline", path=img_path):
+        image_name = os.path.splitext(os.path.basename(img_path))[0]
+        if image is None:
+            image = read_image(img_path)
+        outlined = render_outline(img_path, image, mask, channel, color, metadata, downscale)
+        path = f"{os.path.join(output_path, image_name)}_outlines.png"
+        Image.fromarray(outlined).save(path, compress_level=compress_level)
+    return path
+
+
+def render_outline(img_path: str, image: np.ndarray, mask: np.ndarray, channel=0, color="r",
+                   metadata=None, downscale: int = 1) -> np.ndarray:
+    """
+    The image as YX3 uint8 with the outlines of the mask drawn over it. CZI images are shown by their first
+    channel in the color of the given channel, other images that aren't uint8 are scaled to their range.
+    """
+    from matplotlib import colors
+    if img_path.endswith(".czi"):
+        if metadata is None:
+            metadata = load_metadata(img_path, METADATA_SUFFIX)[0]
+        rgb = _to_uint8(image[:, :, 0], _czi_channel_color(metadata, channel))
+    else:
+        rgb = _to_uint8(image)
+    if downscale > 1:
+        from PIL import Image
+        rgb = np.array(Image.fromarray(rgb).reduce(downscale))
+        mask = mask[::downscale, ::downscale]
+    elif np.shares_memory(rgb, image):
+        rgb = rgb.copy()
+    rgb[outline_mask(mask)] = (np.array(colors.to_rgb(color)) * 255).astype(np.uint8)
+    return rgb
+
+
+def outline_mask(mask: np.ndarray) -> np.ndarray:
+    """
+    Pixels of every labeled cell that touch another label, the background or the image border.
+    """
+    outline = np.zeros(mask.shape, dtype=bool)
+    vertical = mask[1:] != mask[:-1]
+    horizontal = mask[:, 1:] != mask[:, :-1]
+    outline[1:] |= vertical
+    outline[:-1] |= vertical
+    outline[:, 1:] |= horizontal
+    outline[:, :-1] |= horizontal
+    outline[[0, -1], :] = True
+    outline[:, [0, -1]] = True
+    outline &= mask != 0
+    return outline
+
+
+def _to_uint8(image: np.ndarray, tint: Optional[np.ndarray] = None) -> np.ndarray:
+    # uint8 RGB images are used as they are, everything else is scaled from its range to 0-255 in float32
+    if image.ndim == 2:
+        image = image[:, :, None]
+    if image.shape[2] in (2, 4):
+        # Without the alpha channel
+        image = image[:, :, :-1]
+    if image.dtype == np.uint8 and tint is None:
+        return np.repeat(image, 3, axis=2) if image.shape[2] == 1 else image
+    im_min, im_max = float(image.min()), float(image.max())
+    scale = np.float32(255 / (im_max - im_min) if im_max > im_min else 0)
+    scaled = (image.astype(np.float32) - np.float32(im_min)) * scale
+    if tint is not None:
+        scaled = scaled * tint.astype(np.float32)
+    rgb = scaled.astype(np.uint8)
+    return np.repeat(rgb, 3, axis=2) if rgb.shape[2] == 1 else rgb
+
+
+def _czi_channel_color(metadata, channel) -> np.ndarray:
+    from matplotlib import colors
+    channels_info = metadata.find(".//Information/Image/Dimensions/Channels")
+    if isinstance(channel, str):
+        c = channels_info.find(f'.//Channel[@Name="{channel}"]/Color').text
+    elif isinstance(channel, int):
+        c = channels_info.findall('.//Channel/Color')[channel].text
+    else:
+        c = channels_info.find('.//Channel/Color').text
+    return np.array(colors.to_rgb(f"#{c[3:]}"))
 
 
 def load_image(img_path: str, channel: int, rgb=False, czi_all_channels=False):
-    if any(img_path.endswith(e) for e in IMAGE_EXTENSIONS):
-        img = cpio.imread(img_path)
+    return extract_channel(img_path, read_image(img_path), channel, rgb, czi_all_channels)
+
+
+def read_image(img_path: str) -> np.ndarray:
+    """
+    Decodes an image with all of its channels, YXC for CZI files, through the active image cache if set.
+    """
+    if _image_cache is not None:
+        return _image_cache.get_image(img_path)
+    return _read_image(img_path)[0]
+
+
+def _read_image(img_path: str):
+    with profiling.stage("decode", path=img_path):
+        if is_image_file(img_path):
+            from cellpose import io as cpio
+            return cpio.imread(img_path), None
+        if img_path.endswith(".czi"):
+            from aicsimageio import AICSImage
+            img = AICSImage(img_path)
+            return img.get_image_data("YXC"), img.metadata
+
+
+def load_lazy_image(img_path: str):
+    """
+    The image as a YXC dask array, only the parts that are computed are read from disk.
+    """
+    from aicsimageio import AICSImage
+    return AICSImage(img_path).get_image_dask_data("YXC")
+
+
+def extract_channel(img_path: str, img: np.ndarray, channel: int, rgb=False, czi_all_channels=False):
+    if is_image_file(img_path):
         if rgb:
             return img
         if channel == 0 or channel is None:
+            from skimage import color
             return color.rgb2gray(img)
-        return img[:,:,channel - 1]
+        return np.ascontiguousarray(img[:,:,channel - 1])
     if img_path.endswith(".czi"):
-        img = AICSImage(img_path)
         if (czi_all_channels):
-            return img.get_image_data("YXC")
+            return img
         if isinstance(channel, str):
             channel = get_czi_channel_index(img_path, channel)
-        return img.get_image_data("YX", C=channel)
+        return np.ascontiguousarray(img[:,:,channel])
     
 
 def get_czi_channel_index(czi_path, channel):
-    metadata = load_metadata(czi_path, ".tif_metadata.xml")
+    metadata = load_metadata(czi_path, METADATA_SUFFIX)
     channels_info = metadata[0].find(".//Information/Image/Dimensions/Channels")
     c = channels_info.find(f'.//Channel[@Name="{channel}"]')
     channels_info = list(channels_info)
@@ -0,0 +1,84 @@
+import os
+import json
+import tempfile
+from typing import Dict, List
+import pandas as pd
+
+
+class Manifest:
+    """
+    Sidecar file recording which input files were already processed into an output, by path,
+    modification time and size, together with the size of every output file once those files'
+    rows were written. It is saved after every written chunk, so an interrupted run can be resumed.
+    """
+
+    VERSION = 1
+
+    def __init__(self, output_file: str) -> None:
+        self.path = f"{output_file}.manifest.json"
+        self.files: Dict[str, dict] = {}
+        self.outputs: Dict[str, int] = {}
+        if os.path.isfile(self.path) and os.path.isfile(output_file):
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("version") != Manifest.VERSION:
+                raise ValueError(f"Unsupported manifest version in {self.path}")
+            self.files = data["files"]
+            self.outputs = data["outputs"]
+
+
+    @staticmethod
+    def file_state(img_path: str) -> dict:
+        stat = os.stat(img_path)
+        return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+    def is_current(self, img_path: str) -> bool:
+        entry = self.files.get(os.path.abspath(img_path))
+        return entry is not None and all(entry[k] == v for k, v in Manifest.file_state(img_path).items())
+
+
+    def save(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": Manifest.VERSION, "files": self.files, "outputs": self.outputs}, f)
+        os.replace(tmp_path, self.path)
+
+
+    def commit(self, img_paths: List[str], sources: List[str], outputs: List[str]) -> None:
+        for img_path, source in zip(img_paths, sources):
+            self.files[os.path.abspath(img_path)] = {"source": source, **Manifest.file_state(img_path)}
+        self.outputs = {o: os.path.getsize(o) for o in outputs}
+        self.save()
+
+
+    def restore_outputs(self, outputs: List[str]) -> None:
+        """
+        Cuts every output back to its size at the last commit, dropping rows of an interrupted chunk.
+        """
+        if not self.files:
+            return
+        if set(outputs) != set(self.outputs.keys()):
+            raise ValueError(f"Outputs {sorted(outputs)} do not match the ones recorded in {self.path}: "\
+                             f"{sorted(self.outputs.keys())}. Rerun without incremental processing.")
+        for output, size in self.outputs.items():
+            if not os.path.isfile(output) or os.path.getsize(output) < size:
+                raise ValueError(f"{output} is shorter than recorded in {self.path}. "\
+                                 "Rerun without incremental processing.")
+            os.truncate(output, size)
+
+
+    def drop(self, img_paths: List[str], outputs: List[str]) -> None:
+        """
+        Removes files, and their rows in the outputs, from the manifest so they can be processed again.
+        """
+        entries = [self.files.pop(os.path.abspath(p)) for p in img_paths if os.path.abspath(p) in self.files]
+        if not entries:
+            return
+        sources = {e["source"] for e in entries}
+        for output in outputs:
+            df = pd.read_csv(output)
+            df[~df["source"].astype(str).isin(sources)].to_csv(output, index=False)
+        self.outputs = {o: os.path.getsize(o) for o in outputs}
+        self.save()
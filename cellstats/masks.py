@@ -0,0 +1,81 @@
+import os
+from typing import List, Optional, Sequence
+import numpy as np
+
+MASK_EXTENSION = ".npy"
+
+
+def mask_dtype(max_label: int) -> np.dtype:
+    """
+    The smallest unsigned integer dtype holding every label up to max_label.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def compact_mask(mask: np.ndarray) -> np.ndarray:
+    mask = np.asarray(mask)
+    return mask.astype(mask_dtype(int(mask.max()) if mask.size else 0), copy=False)
+
+
+class MaskStore(Sequence):
+    """
+    Label masks stored as one .npy file per image in a directory, in the smallest dtype that fits their
+    labels. Masks are read back memory-mapped, so only the pages of the image in use are held in memory.
+    names gives the order of the masks, by default every mask in the directory sorted by name. If names are
+    given, FileNotFoundError is raised when the mask of any of them is missing.
+    """
+
+    def __init__(self, directory: str, names: Optional[List[str]] = None, mmap: bool = True) -> None:
+        self.directory = directory
+        self.mmap = mmap
+        if names is None:
+            names = sorted(f[:-len(MASK_EXTENSION)] for f in os.listdir(directory) if f.endswith(MASK_EXTENSION)) \
+                if os.path.isdir(directory) else []
+        self.names: List[str] = [self.__name(n) for n in names]
+        missing = [n for n in self.names if not os.path.isfile(self.path(n))]
+        if missing:
+            raise FileNotFoundError(f"No masks of {len(missing)} images in {directory}, e.g. {self.path(missing[0])}")
+
+
+    @staticmethod
+    def __name(name: str) -> str:
+        # Input names may be full paths when a single file is processed
+        return os.path.basename(name)
+
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{self.__name(name)}{MASK_EXTENSION}")
+
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return MaskStore(self.directory, self.names[i], self.mmap)
+        return self.get(self.names[i])
+
+
+    def get(self, name: str) -> np.ndarray:
+        return np.load(self.path(name), mmap_mode="r" if self.mmap else None)
+
+
+    def append(self, name: str, mask: np.ndarray) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        # Written next to the target and moved in place, an interrupted write never leaves a truncated mask
+        tmp_path = self.path(name) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, compact_mask(mask))
+        os.replace(tmp_path, self.path(name))
+        name = self.__name(name)
+        if name not in self.names:
+            self.names.append(name)
+
+
+    def extend(self, names: Sequence[str], masks: Sequence[np.ndarray]) -> None:
+        for name, mask in zip(names, masks):
+            self.append(name, mask)
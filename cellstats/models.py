@@ -1,19 +1,31 @@
 import os
-from typing import Optional
-import shutil
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple
 import pathlib
-from cellstats import io
+from cellstats import profiling
+
+if TYPE_CHECKING:
+    import numpy as np
 
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff"}
 _MODEL_DIR_ENV = os.environ.get("CELLSTATS_ENVIRONMENT_MODEL_REPOSITORY")
 _MODEL_DIR_DEFAULT = pathlib.Path.home().joinpath('.cellstats', 'models')
+_MODEL_CACHE_DIR_ENV = os.environ.get("CELLSTATS_MODEL_CACHE")
+_INDEX_FILE = ".index.json"
+_INDEX_VERSION = 1
+# Cellpose's own defaults, which are already the fast path: no test-time augmentation and no rescaling
+# to a diameter. batch_size is also the largest number of same-shape images evaluated together.
+DEFAULT_EVAL_PARAMS = {"channels": [0, 0], "batch_size": 8, "diameter": None, "augment": False,
+                       "resample": True, "flow_threshold": 0.4, "cellprob_threshold": 0.0}
+# Parameters that only change how fast masks are computed, not the masks. Cellpose 4 ignores channels.
+THROUGHPUT_EVAL_PARAMS = {"batch_size", "channels"}
 
-
-if not os.path.exists(_MODEL_DIR_DEFAULT):
-    os.makedirs(_MODEL_DIR_DEFAULT)
-
-if _MODEL_DIR_ENV and not os.path.exists(_MODEL_DIR_ENV):
-    os.makedirs(_MODEL_DIR_ENV)
+# Parsed indexes by path, together with the modification time they were read at
+_indexes: Dict[str, Tuple[int, Dict[str, dict]]] = {}
 
 
 def __get_model_dir(environment: bool):
@@ -23,30 +35,253 @@ def __get_model_dir(environment: bool):
     return pathlib.Path(_MODEL_DIR_ENV) if environment else _MODEL_DIR_DEFAULT
 
 
-def predict_masks(input_path, model_path, use_gpu, channel, verbose=False, output_path=None, return_image_names=False):
-    from cellpose import models as cpmodels
-    if not os.path.isfile(model_path):
-        model_path_local = os.fspath(__get_model_dir(False).joinpath(model_path))
-        model_path_env = os.fspath(__get_model_dir(True).joinpath(model_path))
+class ModelEntry(NamedTuple):
+    name: str
+    path: str
+    size: int
+    sha256: str
+    added: float
 
-        if not os.path.isfile(model_path_local) and not os.path.isfile(model_path_env):
-            raise FileNotFoundError(f"Model {model_path} does not exist")
 
-        # At this point one is true for sure. Local takes precedence
-        if os.path.isfile(model_path_local):
-            model_path = model_path_local
-        else:
-            model_path = model_path_env
+def _copy_with_digest(source_path: str, target) -> str:
+    h = hashlib.sha256()
+    with open(source_path, "rb") as f:
+        for block in iter(lambda: f.read(16 * 1024 ** 2), b""):
+            h.update(block)
+            if target is not None:
+                target.write(block)
+    return h.hexdigest()
+
+
+def _read_index_file(model_dir: pathlib.Path) -> Optional[Dict[str, dict]]:
+    index_path = os.fspath(model_dir.joinpath(_INDEX_FILE))
+    try:
+        mtime = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if index_path not in _indexes or _indexes[index_path][0] != mtime:
+        with open(index_path) as f:
+            data = json.load(f)
+        if data.get("version") != _INDEX_VERSION:
+            raise ValueError(f"Unsupported model index version in {index_path}")
+        _indexes[index_path] = (mtime, data["models"])
+    return _indexes[index_path][1]
+
+
+def _write_index_file(model_dir: pathlib.Path, index: Dict[str, dict]) -> None:
+    # Replaced atomically, so jobs reading the index concurrently never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=model_dir, prefix=".", suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"version": _INDEX_VERSION, "models": index}, f, indent=1)
+    os.replace(tmp_path, model_dir.joinpath(_INDEX_FILE))
+
+
+def _index_entry(path: str, digest: str, added: Optional[float] = None) -> dict:
+    return {"path": os.path.basename(path), "size": os.path.getsize(path), "sha256": digest,
+            "added": time.time() if added is None else added}
+
+
+def _build_index(model_dir: pathlib.Path, previous: Optional[Dict[str, dict]] = None) -> Dict[str, dict]:
+    previous = previous or {}
+    index = {}
+    for name in sorted(os.listdir(model_dir)):
+        path = os.fspath(model_dir.joinpath(name))
+        if name.startswith(".") or not os.path.isfile(path):
+            continue
+        added = previous[name]["added"] if name in previous else os.path.getmtime(path)
+        index[name] = _index_entry(path, _copy_with_digest(path, None), added)
+    return index
+
+
+def _load_index_for_update(model_dir: pathlib.Path) -> Dict[str, dict]:
+    # Repositories from before the index are indexed on their first change
+    os.makedirs(model_dir, exist_ok=True)
+    index = _read_index_file(model_dir)
+    return dict(index) if index is not None else _build_index(model_dir)
+
+
+def reindex(environment: bool) -> Dict[str, dict]:
+    """
+    Rebuilds the index of a model repository from its files, for models that were copied in by hand.
+    """
+    model_dir = __get_model_dir(environment)
+    os.makedirs(model_dir, exist_ok=True)
+    index = _build_index(model_dir, _read_index_file(model_dir))
+    _write_index_file(model_dir, index)
+    return index
+
+
+def _cached_model_path(model_path: str, entry: dict) -> str:
+    """
+    Local copy of a model from the environment repository, named by its hash. Copies are verified
+    against the hash in the index once, when they are made.
+    """
+    cache_dir = pathlib.Path(_MODEL_CACHE_DIR_ENV)
+    cached_path = os.fspath(cache_dir.joinpath(entry["sha256"]))
+    if os.path.isfile(cached_path) and os.path.getsize(cached_path) == entry["size"]:
+        return cached_path
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            digest = _copy_with_digest(model_path, f)
+        if digest != entry["sha256"]:
+            raise ValueError(f"{model_path} does not match its hash in the model index. It was changed without "\
+                             "updating the index, add it again or run: cellstats model reindex -e")
+        os.replace(tmp_path, cached_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return cached_path
+
+
+def resolve_model_path(model_path: str) -> str:
+    if os.path.isfile(model_path):
+        return model_path
+    repositories = [False, True] if _MODEL_DIR_ENV else [False]
+
+    # Local takes precedence
+    for environment in repositories:
+        model_dir = __get_model_dir(environment)
+        entry = (_read_index_file(model_dir) or {}).get(model_path)
+        if entry is not None:
+            indexed_path = os.fspath(model_dir.joinpath(entry["path"]))
+            if environment and _MODEL_CACHE_DIR_ENV:
+                return _cached_model_path(indexed_path, entry)
+            return indexed_path
+
+    # Models copied into a repository by hand are not in its index
+    for environment in repositories:
+        candidate = os.fspath(__get_model_dir(environment).joinpath(model_path))
+        if os.path.isfile(candidate):
+            return candidate
+    raise FileNotFoundError(f"Model {model_path} does not exist")
+
+
+class ModelPool:
+    """
+    Keeps loaded models in memory for long-lived processes, keyed by model path and device.
+    A model is loaded again once its weights file changes.
+    """
+
+    def __init__(self) -> None:
+        self.__models: Dict[Tuple[str, bool, Optional[str]], Tuple[Tuple[int, int], object]] = {}
+        self.__lock = threading.Lock()
+
+
+    def get(self, model_path: str, use_gpu: bool, device: Optional[str] = None):
+        stat = os.stat(model_path)
+        key, version = (os.path.abspath(model_path), bool(use_gpu), device), (stat.st_mtime_ns, stat.st_size)
+        with self.__lock:
+            entry = self.__models.get(key)
+            if entry is None or entry[0] != version:
+                self.__models[key] = (version, _create_model(model_path, use_gpu, device))
+            return self.__models[key][1]
 
-    input_images, input_image_names = io.load_images(input_path, channel)
+
+    def loaded(self) -> List[Tuple[str, bool, Optional[str]]]:
+        with self.__lock:
+            return list(self.__models.keys())
+
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__models.clear()
+
+
+_model_pool: Optional[ModelPool] = None
+
+
+def get_model_pool() -> Optional[ModelPool]:
+    return _model_pool
+
+
+def set_model_pool(pool: Optional[ModelPool]) -> Optional[ModelPool]:
+    global _model_pool
+    previous, _model_pool = _model_pool, pool
+    return previous
+
+
+def _create_model(model_path: str, use_gpu: bool, device: Optional[str] = None):
+    with profiling.stage("load_model", path=model_path, device=device):
+        from cellpose import models as cpmodels
+        if device is not None:
+            import torch
+            return cpmodels.CellposeModel(gpu=use_gpu, pretrained_model=model_path, device=torch.device(device))
+        return cpmodels.CellposeModel(gpu=use_gpu, pretrained_model=model_path)
+
+
+def load_model(model_path: str, use_gpu: bool, verbose=False, device: Optional[str] = None):
+    model_path = resolve_model_path(model_path)
 
     if verbose:
         from cellpose.io import logger_setup
         logger_setup()
 
-    model = cpmodels.CellposeModel(gpu=use_gpu, pretrained_model=model_path)
+    if _model_pool is not None:
+        return _model_pool.get(model_path, use_gpu, device)
+    return _create_model(model_path, use_gpu, device)
+
+
+class BatchTiming(NamedTuple):
+    shape: Tuple[int, ...]
+    images: int
+    seconds: float
 
-    masks, _, _ = model.eval(input_images, channels=[0,0])
+
+def shape_batches(images: List["np.ndarray"], batch_size: int) -> List[List[int]]:
+    """
+    Indices of the images grouped by shape and dtype, at most batch_size per group.
+    """
+    groups: Dict[tuple, List[int]] = {}
+    for i, img in enumerate(images):
+        groups.setdefault((img.shape, img.dtype.str), []).append(i)
+    return [indices[start:start + batch_size] for indices in groups.values()
+            for start in range(0, len(indices), batch_size)]
+
+
+def mask_eval_params(eval_params: Optional[dict] = None) -> dict:
+    """
+    The evaluation parameters that determine the masks, with unset ones at their defaults.
+    """
+    eval_params = {**DEFAULT_EVAL_PARAMS, **(eval_params or {})}
+    return {k: v for k, v in eval_params.items() if k not in THROUGHPUT_EVAL_PARAMS}
+
+
+def segment(model, images: List["np.ndarray"], eval_params: Optional[dict] = None,
+            timings: Optional[List[BatchTiming]] = None) -> List["np.ndarray"]:
+    """
+    Segments images in batches of the same shape, each evaluated as one stack so the network runs on
+    tiles of several images at once. Masks are returned in the order of the images.
+    """
+    import numpy as np
+    eval_params = {**DEFAULT_EVAL_PARAMS, **(eval_params or {})}
+    eval_params.setdefault("channel_axis", -1)
+    masks: List[Optional[np.ndarray]] = [None] * len(images)
+    for indices in shape_batches(images, max(int(eval_params["batch_size"]), 1)):
+        batch = np.stack([images[i] for i in indices])
+        if batch.ndim == 3:
+            # Single channel images
+            batch = batch[..., None]
+        tic = time.perf_counter()
+        with profiling.stage("segment", images=len(indices), shape=list(batch.shape[1:3])):
+            batch_masks, _, _ = model.eval(batch, **eval_params)
+        profiling.count("segmented_images", len(indices))
+        if timings is not None:
+            timings.append(BatchTiming(images[indices[0]].shape, len(indices), time.perf_counter() - tic))
+        # Masks of a single image come back without the batch axis
+        batch_masks = [batch_masks] if len(indices) == 1 else list(batch_masks)
+        for i, mask in zip(indices, batch_masks):
+            masks[i] = mask
+    return masks
+
+
+def predict_masks(input_path, model_path, use_gpu, channel, verbose=False, output_path=None, return_image_names=False):
+    from cellstats import io
+    model_path = resolve_model_path(model_path)
+    input_images, input_image_names = io.load_images(input_path, channel)
+    model = load_model(model_path, use_gpu, verbose)
+    masks = segment(model, input_images)
 
     if output_path is not None:
         io.save_image_outlines(input_path, output_path, masks, channel, verbose=verbose)
@@ -57,42 +292,83 @@ def predict_masks(input_path, model_path, use_gpu, channel, verbose=False, outpu
 
 def add_model(model_path: str, name: Optional[str], overwrite: bool, environment: bool):
     target_file_name = os.path.split(model_path)[-1] if name is None else name
-    target_path = os.fspath(__get_model_dir(environment).joinpath(target_file_name))
+    model_dir = __get_model_dir(environment)
+    target_path = os.fspath(model_dir.joinpath(target_file_name))
     if os.path.isfile(target_path) and not overwrite:
         raise FileExistsError(f"{target_file_name} already exists in model list. Use --overwtire flag to overwtire")
-    try:
-        shutil.copyfile(model_path, target_path)
-    except shutil.SameFileError:
-        pass
+    index = _load_index_for_update(model_dir)
+    if os.path.isfile(target_path) and os.path.samefile(model_path, target_path):
+        digest = _copy_with_digest(target_path, None)
+    else:
+        # Hashed while copying, and only moved into place once complete
+        fd, tmp_path = tempfile.mkstemp(dir=model_dir, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                digest = _copy_with_digest(model_path, f)
+            os.replace(tmp_path, target_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    index[target_file_name] = _index_entry(target_path, digest)
+    _write_index_file(model_dir, index)
     
 
 def rename_model(old_name: str, new_name: str, overwrite:bool, environment: bool):
     if old_name == new_name: return
-    source_path = os.fspath(__get_model_dir(environment).joinpath(old_name))
+    model_dir = __get_model_dir(environment)
+    source_path = os.fspath(model_dir.joinpath(old_name))
     if not os.path.isfile(source_path):
         raise FileNotFoundError(f"Model not found: {old_name}")
-    target_path = os.fspath(__get_model_dir(environment).joinpath(new_name))
+    target_path = os.fspath(model_dir.joinpath(new_name))
     if os.path.isfile(target_path) and not overwrite:
         raise FileExistsError(f"{new_name} already exists in model list. Use --overwtire flag to overwtire")
+    index = _load_index_for_update(model_dir)
     os.rename(source_path, target_path)
+    entry = index.pop(old_name, None)
+    index[new_name] = {**entry, "path": new_name} if entry is not None else \
+        _index_entry(target_path, _copy_with_digest(target_path, None))
+    _write_index_file(model_dir, index)
 
 
 def remove_model(model_name, environment: bool):
-    model_path = os.fspath(__get_model_dir(environment).joinpath(model_name))
+    model_dir = __get_model_dir(environment)
+    model_path = os.fspath(model_dir.joinpath(model_name))
     if not os.path.isfile(model_path):
         raise FileNotFoundError(f"Model not found: {model_name}")
     
+    index = _load_index_for_update(model_dir)
     os.remove(model_path)
+    index.pop(model_name, None)
+    _write_index_file(model_dir, index)
+
+
+def model_entries(environment: bool) -> List[ModelEntry]:
+    model_dir = __get_model_dir(environment)
+    if not os.path.isdir(model_dir):
+        return []
+    index = _read_index_file(model_dir)
+    if index is None:
+        index = _build_index(model_dir)
+    return [ModelEntry(name, os.fspath(model_dir.joinpath(e["path"])), e["size"], e["sha256"], e["added"])
+            for name, e in index.items()]
+
+
+def __list_dir(environment: bool) -> List[str]:
+    model_dir = __get_model_dir(environment)
+    index = _read_index_file(model_dir)
+    if index is not None:
+        return list(index.keys())
+    if not os.path.isdir(model_dir):
+        return []
+    return [name for name in os.listdir(model_dir) if not name.startswith(".")]
 
 
 def list_models():
     ret_val = {}
     ret_val["environment"] = []
     if _MODEL_DIR_ENV:
-        env_dir = __get_model_dir(True)
-        ret_val["environment"] = os.listdir(env_dir)
-    local_dir = __get_model_dir(False)
-    ret_val["local"] = os.listdir(local_dir)
+        ret_val["environment"] = __list_dir(True)
+    ret_val["local"] = __list_dir(False)
     return ret_val
 
 
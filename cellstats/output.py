@@ -0,0 +1,160 @@
+import os
+from contextlib import contextmanager
+from typing import List
+import numpy as np
+import pandas as pd
+from cellstats import profiling
+
+OUTPUT_FORMATS = ["csv", "parquet", "feather"]
+_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+# Pixel coordinates of whole slides need more precision than float32 offers
+_FLOAT64_COLUMN_PREFIXES = ("centroid", "center_of_mass")
+
+
+def output_extension(output_format: str) -> str:
+    return _EXTENSIONS[output_format]
+
+
+def check_output_path(path: str, output_format: str) -> None:
+    # Intensity tables are named with the extension of the format, the geometry table is written to path as
+    # given, so its extension has to agree. Csv may be written to any file not named like another format.
+    if output_format not in _EXTENSIONS:
+        raise ValueError(f"output_format should be one of {OUTPUT_FORMATS}. Got: {output_format}")
+    ext = os.path.splitext(path)[1].lower()
+    if ext != output_extension(output_format) and (output_format != "csv" or ext in _EXTENSIONS.values()):
+        raise ValueError(f"Output file {path} should have the extension {output_extension(output_format)} "\
+                         f"of {output_format} output")
+
+
+class CsvWriter:
+
+    def __init__(self, path: str, append: bool = False) -> None:
+        self.path = path
+        self.__header_written = append and os.path.isfile(path) and os.path.getsize(path) > 0
+        self.__header_checked = not self.__header_written
+
+
+    def write(self, df: pd.DataFrame) -> None:
+        with profiling.stage("write", path=self.path, rows=len(df)):
+            self.__write(df)
+        profiling.count("written_rows", len(df))
+
+
+    def __write(self, df: pd.DataFrame) -> None:
+        if not self.__header_checked:
+            existing = list(pd.read_csv(self.path, nrows=0).columns)
+            if existing != [str(c) for c in df.columns]:
+                raise ValueError(f"Cannot append to {self.path}, its columns {existing} differ from "\
+                                 f"{list(df.columns)}")
+            self.__header_checked = True
+        df.to_csv(self.path, mode="a" if self.__header_written else "w",
+                  header=not self.__header_written, index=False)
+        self.__header_written = True
+
+
+    def close(self) -> None:
+        pass
+
+
+class _ArrowWriter:
+    """
+    Writes batches of rows to a columnar file as they arrive, each batch as its own row group or record
+    batch. The source column is dictionary encoded against all sources seen so far, so the dictionary
+    only ever grows, and floats are stored as float32 except for coordinates.
+    """
+
+    def __init__(self, path: str) -> None:
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise ImportError("pyarrow is required for parquet and feather output. "\
+                              "Install it with: pip install pyarrow") from e
+        self.path = path
+        self._pa = pyarrow
+        self._schema = None
+        self.__sources: List[str] = []
+        self.__writer = None
+
+
+    def _to_table(self, df: pd.DataFrame):
+        df = df.copy()
+        for col in df.columns:
+            if df[col].dtype == np.float64 and not str(col).startswith(_FLOAT64_COLUMN_PREFIXES):
+                df[col] = df[col].astype(np.float32)
+        table = self._pa.Table.from_pandas(df, preserve_index=False)
+        if "source" in df:
+            table = table.set_column(table.schema.get_field_index("source"), "source",
+                                     self.__encode_sources(df["source"]))
+        if self._schema is None:
+            self._schema = table.schema.remove_metadata()
+        return table.replace_schema_metadata(None).cast(self._schema)
+
+
+    def __encode_sources(self, sources: pd.Series):
+        # Always dictionary<int32, string>, the schema is fixed by the first batch, which may have no rows
+        pa = self._pa
+        sources = sources.astype(str)
+        known = set(self.__sources)
+        self.__sources.extend(s for s in pd.unique(sources) if s not in known)
+        codes = pd.Categorical(sources, categories=self.__sources).codes.astype(np.int32)
+        return pa.DictionaryArray.from_arrays(pa.array(codes, pa.int32()), pa.array(self.__sources, pa.string()))
+
+
+    def write(self, df: pd.DataFrame) -> None:
+        with profiling.stage("write", path=self.path, rows=len(df)):
+            table = self._to_table(df)
+            if self.__writer is None:
+                self.__writer = self._open()
+            self._write_table(self.__writer, table)
+        profiling.count("written_rows", len(df))
+
+
+    def close(self) -> None:
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+
+
+class ParquetWriter(_ArrowWriter):
+
+    def _open(self):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(self.path, self._schema)
+
+
+    def _write_table(self, writer, table) -> None:
+        writer.write_table(table, row_group_size=max(table.num_rows, 1))
+
+
+class FeatherWriter(_ArrowWriter):
+
+    def _open(self):
+        import pyarrow.ipc as ipc
+        return ipc.new_file(self.path, self._schema,
+                            options=ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+
+    def _write_table(self, writer, table) -> None:
+        writer.write_table(table)
+
+
+def open_writer(path: str, output_format: str = "csv", append: bool = False):
+    if output_format == "csv":
+        return CsvWriter(path, append)
+    if append:
+        raise ValueError(f"Appending is only supported for csv output, not {output_format}")
+    if output_format == "parquet":
+        return ParquetWriter(path)
+    if output_format == "feather":
+        return FeatherWriter(path)
+    raise ValueError(f"output_format should be one of {OUTPUT_FORMATS}. Got: {output_format}")
+
+
+@contextmanager
+def closing_writers(writers: list):
+    try:
+        yield writers
+    finally:
+        for writer in writers:
+            writer.close()
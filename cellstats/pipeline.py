@@ -0,0 +1,450 @@
+import os
+import multiprocessing
+import tempfile
+from collections import deque
+from contextlib import closing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+from cellstats import io
+from cellstats import models
+from cellstats import profiling
+from cellstats.cache import MaskCache, file_digest
+from cellstats.manifest import Manifest
+from cellstats.masks import MaskStore
+from cellstats.output import check_output_path, closing_writers, open_writer, output_extension
+from cellstats.post_processing import FeatureExtractor
+
+
+DEFAULT_CACHE_SIZE = 1024 ** 3
+
+
+class Segmenter:
+    """
+    Segments images with a model that is only loaded once an image is not found in the mask cache.
+    With workers, images are split into contiguous shards that are segmented in worker processes,
+    each holding its own model on one of the devices, and the masks are merged back in input order.
+    model_factory loads the model, called as models.load_model, which it defaults to. It has to be a
+    module-level function when segmenting in workers.
+    """
+
+    def __init__(self, model_path: str, use_gpu=False, verbose=False, channel=0,
+                 eval_params: Optional[dict] = None, mask_cache: Optional[MaskCache] = None,
+                 workers: int = 0, devices: Optional[List[str]] = None,
+                 model_factory: Optional[Callable] = None) -> None:
+        self.model_path = models.resolve_model_path(model_path)
+        self.use_gpu = use_gpu
+        self.verbose = verbose
+        self.channel = channel
+        self.eval_params = {**models.DEFAULT_EVAL_PARAMS, **(eval_params or {})}
+        self.mask_cache = mask_cache
+        self.devices = devices
+        self.workers = len(devices) if devices and not workers else workers
+        self.model_factory = model_factory or models.load_model
+        self.timings: List[models.BatchTiming] = []
+        self.__model = None
+        self.__pool = None
+
+
+    def __make_pool(self) -> Executor:
+        devices = self.devices or [None]
+        ctx = multiprocessing.get_context("spawn")
+        device_queue = ctx.Queue()
+        for i in range(self.workers):
+            device_queue.put(devices[i % len(devices)])
+        # Every worker gets an equal share of the cores, so their thread pools don't oversubscribe them
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        return ProcessPoolExecutor(self.workers, mp_context=ctx, initializer=_init_segmentation_worker,
+                                   initargs=(self.model_factory, self.model_path, self.use_gpu, self.verbose,
+                                             device_queue, threads))
+
+
+    def __segment(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        if self.workers > 0:
+            if self.__pool is None:
+                self.__pool = self.__make_pool()
+            bounds = np.linspace(0, len(images), min(self.workers, len(images)) + 1).astype(int)
+            shards = [_submit(self.__pool, _segment_shard, images[start:end], self.eval_params)
+                      for start, end in zip(bounds[:-1], bounds[1:])]
+            masks = []
+            for shard in shards:
+                shard_masks, timings = _result(shard)
+                masks.extend(shard_masks)
+                self.__report(timings)
+            return masks
+        if self.__model is None:
+            self.__model = self.model_factory(self.model_path, self.use_gpu, self.verbose,
+                                              self.devices[0] if self.devices else None)
+        timings = []
+        masks = models.segment(self.__model, images, self.eval_params, timings)
+        self.__report(timings)
+        return masks
+
+
+    def __report(self, timings: List[models.BatchTiming]) -> None:
+        self.timings.extend(timings)
+        if self.verbose:
+            for t in timings:
+                print(f"Segmented {t.images} images of shape {t.shape} in {t.seconds:.2f}s "\
+                      f"({t.images / max(t.seconds, 1e-9):.2f} images/s)")
+
+
+    def close(self) -> None:
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+
+
+    def __call__(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        if self.mask_cache is None:
+            return self.__segment(images)
+        model_digest = file_digest(self.model_path)
+        eval_params = models.mask_eval_params(self.eval_params)
+        keys = [self.mask_cache.key(img, self.channel, model_digest, eval_params) for img in images]
+        masks = [self.mask_cache.get(k) for k in keys]
+        missing = [i for i, mask in enumerate(masks) if mask is None]
+        profiling.count("mask_cache_hits", len(masks) - len(missing))
+        profiling.count("mask_cache_misses", len(missing))
+        if missing:
+            for i, mask in zip(missing, self.__segment([images[i] for i in missing])):
+                self.mask_cache.put(keys[i], mask)
+                masks[i] = mask
+        return masks
+
+
+def intensity_output_path(output_file: str, channel=None, output_format: str = "csv") -> str:
+    # A single wide table for all channels when no channel is given
+    base, ext = os.path.splitext(output_file)[0], output_extension(output_format)
+    if channel is None:
+        return f"{base}_intensity{ext}"
+    return f"{base}_intensity_{channel}{ext}"
+
+
+def intensity_frames(fe: FeatureExtractor, intensity_channels: List, wide: bool,
+                      thresholds: Optional[dict] = None) -> dict:
+    if wide:
+        return {None: fe.get_intensity_features(list(intensity_channels), None, thresholds)}
+    return {ic: fe.get_intensity_features(ic, None, thresholds.get(ic) if thresholds else None)
+            for ic in intensity_channels}
+
+
+def iter_chunks(items: Sequence, chunk_size: Optional[int]) -> Iterator[Sequence]:
+    if chunk_size is None or chunk_size <= 0:
+        chunk_size = max(len(items), 1)
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def _with_sources(df: pd.DataFrame, paths: List[str], names: List[str]) -> pd.DataFrame:
+    # Features are extracted from the full paths, but rows are reported by the input name
+    if "source" in df:
+        df["source"] = df["source"].map(dict(zip(paths, names)))
+    return df
+
+
+class InlineExecutor(Executor):
+    # Runs tasks in the calling thread, used when no worker pool was requested
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def _make_executor(workers: int, processes: bool, initializer=None, initargs=()) -> Executor:
+    if workers <= 0:
+        return InlineExecutor()
+    if processes:
+        # Spawned rather than forked, the parent may already hold torch's thread pools
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=initializer, initargs=initargs)
+    return ThreadPoolExecutor(workers, initializer=initializer, initargs=initargs)
+
+
+def _submit(pool: Executor, fn, *args) -> Future:
+    # When profiling, what a task records is returned with its result, also from worker processes
+    if profiling.enabled():
+        return pool.submit(profiling.collect, fn, *args)
+    return pool.submit(fn, *args)
+
+
+def _result(future: Future):
+    if profiling.enabled():
+        result, recorded = future.result()
+        profiling.get_profiler().merge(recorded)
+        return result
+    return future.result()
+
+
+def _init_worker(cache_size: Optional[int]) -> None:
+    io.set_image_cache(io.ImageCache(cache_size))
+
+
+_worker_model = None
+
+
+def _init_segmentation_worker(model_factory: Callable, model_path: str, use_gpu: bool, verbose: bool, device_queue,
+                              threads: int) -> None:
+    global _worker_model
+    # Set before torch is first imported in this process, so its thread pools are sized accordingly
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    device = device_queue.get()
+    _worker_model = model_factory(model_path, use_gpu and device != "cpu", verbose, device)
+
+
+def _segment_shard(images: List[np.ndarray], eval_params: dict):
+    timings = []
+    return models.segment(_worker_model, images, eval_params, timings), timings
+
+
+def _load_image(img_path: str, channel):
+    img = io.read_image(img_path)
+    return img, io.extract_channel(img_path, img, channel)
+
+
+def _load_metadata(paths: List[str]) -> dict:
+    metadata = {}
+    for p in paths:
+        try:
+            metadata[io.metadata_path(p)] = io.load_metadata(p, io.METADATA_SUFFIX)[0]
+        except FileNotFoundError:
+            pass
+    return metadata
+
+
+def _seed_metadata(metadata: dict) -> None:
+    # Parsed metadata is handed over from the loading stage, whether extraction runs in this process or in
+    # a worker. Decoded images are given to the FeatureExtractor directly, they would not outlive an LRU scan
+    # over a chunk larger than the cache.
+    cache = io.get_image_cache()
+    if cache is None:
+        return
+    for md_path, md in metadata.items():
+        cache.put_metadata(md_path, md)
+
+
+def _chunk_scales(run_scales: dict, paths: List[str]) -> np.ndarray:
+    return np.array([run_scales[p] for p in paths]) if run_scales else np.array([])
+
+
+def _extract_chunk(masks: List[np.ndarray], paths: List[str], names: List[str], images: List[np.ndarray],
+                   metadata: dict, scales: np.ndarray, features: Optional[List[str]], intensity_channels: List,
+                   deferred: bool, wide: bool):
+    _seed_metadata(metadata)
+    fe = FeatureExtractor(masks, files=paths, scales=scales, intensity_channels=intensity_channels,
+                          images=list(images))
+    geometry = _with_sources(fe.get_geometrical_features(features), paths, names)
+    if deferred:
+        intensity = {ic: fe.get_fraction_filled_thresholds(ic) for ic in intensity_channels}
+    else:
+        intensity = {key: _with_sources(df, paths, names)
+                     for key, df in intensity_frames(fe, intensity_channels, wide).items()}
+    return geometry, intensity
+
+
+def _extract_intensity_chunk(masks_dir: str, paths: List[str], names: List[str], images: List[np.ndarray],
+                             metadata: dict, scales: np.ndarray, thresholds: dict, wide: bool):
+    _seed_metadata(metadata)
+    fe = FeatureExtractor(MaskStore(masks_dir, names), files=paths, scales=scales,
+                          intensity_channels=list(thresholds.keys()), images=list(images))
+    return {key: _with_sources(df, paths, names)
+            for key, df in intensity_frames(fe, list(thresholds.keys()), wide, thresholds).items()}
+
+
+def predict(input_path: str, output_file: str, model_path: str, channel=0, use_gpu=False,
+            features: Optional[List[str]] = None, intensity_channels: Optional[List] = None,
+            outline_dir: Optional[str] = None, chunk_size: Optional[int] = None, verbose=False,
+            io_workers: int = 1, cpu_workers: int = 0, cache_size: Optional[int] = DEFAULT_CACHE_SIZE,
+            intensity_output: str = "separate", mask_cache: Optional[MaskCache] = None,
+            incremental: bool = False, output_format: str = "csv", workers: int = 0,
+            devices: Optional[List[str]] = None, eval_params: Optional[dict] = None, progress: bool = False,
+            outline_workers: int = 4, outline_downscale: int = 1,
+            outline_compression: int = io.DEFAULT_OUTLINE_COMPRESSION, mask_dir: Optional[str] = None) -> None:
+    image_paths, image_names = io.list_images(input_path)
+    # Resolved once for the whole run, so that no chunk falls back to pixels while others are in physical units
+    run_scales = dict(zip(image_paths, io.load_run_scales(image_paths)))
+    intensity_channels = intensity_channels or []
+    wide = intensity_output == "wide"
+    if intensity_output not in ("separate", "wide"):
+        raise ValueError(f"intensity_output should be 'separate' or 'wide'. Got: {intensity_output}")
+    if incremental and output_format != "csv":
+        raise ValueError(f"Incremental processing is only supported for csv output, not {output_format}")
+    check_output_path(output_file, output_format)
+    if wide:
+        intensity_outputs = {None: intensity_output_path(output_file, None, output_format)} if intensity_channels else {}
+    else:
+        intensity_outputs = {ic: intensity_output_path(output_file, ic, output_format) for ic in intensity_channels}
+    outputs = [output_file] + list(intensity_outputs.values())
+
+    manifest = None
+    if incremental:
+        # Only files that are new or changed since they were last processed into the output are processed,
+        # rows of changed files and of an interrupted run are removed first
+        manifest = Manifest(output_file)
+        manifest.restore_outputs(outputs)
+        manifest.drop([p for p in image_paths if os.path.abspath(p) in manifest.files and not manifest.is_current(p)],
+                      outputs)
+        todo = [i for i, p in enumerate(image_paths) if not manifest.is_current(p)]
+        image_paths = [image_paths[i] for i in todo]
+        image_names = [image_names[i] for i in todo]
+        if verbose:
+            print(f"{len(image_paths)} new or changed files to process")
+
+    chunks = list(iter_chunks(list(range(len(image_paths))), chunk_size))
+    segment = Segmenter(model_path, use_gpu, verbose, channel, eval_params, mask_cache, workers, devices)
+    if outline_dir is not None:
+        os.makedirs(outline_dir, exist_ok=True)
+        print(f"Saving masks to {outline_dir}. This might take a while...")
+
+    # Without a manifest there is nothing to resume and existing outputs are overwritten
+    append = manifest is not None and len(manifest.files) > 0
+    geometry_writer = open_writer(output_file, output_format, append)
+    intensity_writers = {key: open_writer(path, output_format, append) for key, path in intensity_outputs.items()}
+
+    # fraction_filled thresholds each cell against the mean Otsu threshold of all cells in the run.
+    # With more than one chunk that mean is only known after every chunk was seen, so masks are
+    # spilled to disk and intensity features are written in a second pass, reading them memory-mapped. Incremental runs commit
+    # every chunk on its own, so there the threshold is taken per chunk.
+    deferred = len(intensity_channels) > 0 and len(chunks) > 1 and not incremental
+    thresholds = {ic: [] for ic in intensity_channels}
+
+    # Finished chunks are written strictly in input order. At most cpu_workers chunks are kept in
+    # flight so memory stays bounded even when extraction is slower than segmentation.
+    pending = deque()
+    max_pending = max(cpu_workers, 0)
+    # Advances as the rows of every chunk are written
+    progress_bar = profiling.Progress(len(image_paths)) if progress else None
+
+    def write_finished(limit: int) -> None:
+        while len(pending) > limit:
+            future, outlines, paths, names = pending.popleft()
+            with profiling.stage("wait_extraction"):
+                geometry, intensity = _result(future)
+            for p, outline in zip(paths, outlines):
+                _result(outline)
+                print(f"Saved outline for {os.path.splitext(os.path.basename(p))[0]}")
+            geometry_writer.write(geometry)
+            for key, res in intensity.items():
+                if deferred:
+                    thresholds[key].append(res)
+                else:
+                    intensity_writers[key].write(res)
+            if manifest is not None:
+                manifest.commit(paths, names, outputs)
+            if progress_bar is not None:
+                progress_bar.update(len(paths))
+
+    with tempfile.TemporaryDirectory(prefix="cellstats_") as spill_dir, \
+            closing_writers([geometry_writer] + list(intensity_writers.values())), \
+            closing(segment), \
+            io.image_cache(cache_size), \
+            _make_executor(io_workers, processes=False) as io_pool, \
+            _make_executor(outline_workers if outline_dir is not None else 0, processes=False) as outline_pool, \
+            _make_executor(cpu_workers, processes=True, initializer=_init_worker, initargs=(cache_size,)) as cpu_pool:
+
+        # Masks asked to be kept are saved to mask_dir, which then also serves as the spill of the second pass
+        mask_store = None
+        if mask_dir is not None:
+            mask_store = MaskStore(mask_dir, [])
+        elif deferred:
+            mask_store = MaskStore(os.path.join(spill_dir, "masks"), [])
+
+        def load_chunk(chunk) -> List[Future]:
+            return [io_pool.submit(_load_image, image_paths[i], channel) for i in chunk]
+
+        # The next chunk is decoded while the model evaluates the current one
+        next_images = load_chunk(chunks[0]) if chunks else []
+        for chunk_idx, chunk in enumerate(chunks):
+            paths = [image_paths[i] for i in chunk]
+            names = [image_names[i] for i in chunk]
+            images, seg_images = zip(*[f.result() for f in next_images])
+            next_images = load_chunk(chunks[chunk_idx + 1]) if chunk_idx + 1 < len(chunks) else []
+            masks = segment(list(seg_images))
+            del seg_images
+
+            if mask_store is not None:
+                mask_store.extend(names, masks)
+            metadata = _load_metadata(paths)
+            # Outlines are drawn on the decoded images in threads, next to feature extraction
+            outlines = []
+            if outline_dir is not None:
+                outlines = [_submit(outline_pool, io.save_image_outline, p, outline_dir, mask, channel, "r", img,
+                                    metadata.get(io.metadata_path(p)), outline_downscale, outline_compression)
+                            for p, img, mask in zip(paths, images, masks)]
+            pending.append((_submit(cpu_pool, _extract_chunk, masks, paths, names, list(images),
+                                    metadata, _chunk_scales(run_scales, paths), features, intensity_channels,
+                                    deferred, wide),
+                            outlines, paths, names))
+            del masks, images
+            write_finished(max_pending)
+        write_finished(0)
+        if progress_bar is not None:
+            progress_bar.close()
+
+        if not deferred:
+            return
+
+        thresholds = {ic: np.concatenate(th).mean() for ic, th in thresholds.items()}
+        pending_intensity = deque()
+        progress_bar = profiling.Progress(len(image_paths), "images", "intensity") if progress else None
+        for chunk_idx, chunk in enumerate(chunks):
+            paths = [image_paths[i] for i in chunk]
+            names = [image_names[i] for i in chunk]
+            images = [io_pool.submit(io.read_image, p) for p in paths]
+            pending_intensity.append((_submit(cpu_pool, _extract_intensity_chunk, mask_store.directory,
+                                              paths, names, [f.result() for f in images],
+                                              _load_metadata(paths), _chunk_scales(run_scales, paths),
+                                              thresholds, wide),
+                                      len(paths)))
+            del images
+            while len(pending_intensity) > max_pending or \
+                    (chunk_idx == len(chunks) - 1 and pending_intensity):
+                future, n = pending_intensity.popleft()
+                with profiling.stage("wait_extraction"):
+                    frames = _result(future)
+                for key, df in frames.items():
+                    intensity_writers[key].write(df)
+                if progress_bar is not None:
+                    progress_bar.update(n)
+        if progress_bar is not None:
+            progress_bar.close()
+
+
+def run_job(job: dict) -> None:
+    """
+    Runs a predict job as built by the command line, either in this process or in a model server.
+    """
+    profiler = profiling.Profiler() if job["profile"] else None
+    previous = profiling.set_profiler(profiler)
+    try:
+        _run_job(job)
+    finally:
+        profiling.set_profiler(previous)
+        if profiler is not None:
+            profiler.save(job["profile"], job["profile_format"])
+
+
+def _run_job(job: dict) -> None:
+    mask_cache = MaskCache() if job["mask_cache"] else None
+    if job["tile_size"] is not None:
+        from cellstats import tiling
+        tiling.predict_tiled(job["input_file"], job["output_file"], job["model"], job["channel"], job["gpu"],
+                             job["features"], job["intensity_channels"], job["tile_size"], job["tile_overlap"],
+                             job["verbose"], job["intensity_output"], mask_cache, job["output_format"],
+                             job["eval_params"], job["progress"])
+    else:
+        predict(job["input_file"], job["output_file"], job["model"], job["channel"], job["gpu"], job["features"],
+                job["intensity_channels"], job["outline_dir"], job["chunk_size"], job["verbose"],
+                job["io_workers"], job["cpu_workers"], job["cache_size"], job["intensity_output"], mask_cache,
+                job["incremental"], job["output_format"], job["workers"], job["devices"], job["eval_params"],
+                job["progress"], job["outline_workers"], job["outline_downscale"], job["outline_compression"],
+                job["mask_dir"])
+    if mask_cache is not None:
+        mask_cache.prune(job["mask_cache_size"])
@@ -1,19 +1,359 @@
-from skimage.measure import regionprops
 import numpy as np
 import pandas as pd
-from typing import List, Union, Optional
+from typing import Callable, Dict, List, NamedTuple, Sequence, Set, Tuple, Union, Optional
 import warnings
 from cellstats import io
+from cellstats import profiling
+from cellstats.masks import MaskStore
 from skimage import color
+from scipy import ndimage
 import cv2 as cv
 
+_INTENSITY_LEVELS = 256
+
+
+def _blur(img: np.ndarray) -> np.ndarray:
+    img = np.ascontiguousarray(img)
+    if img.dtype not in (np.uint8, np.uint16, np.float32, np.float64):
+        img = img.astype(np.float32)
+    return cv.GaussianBlur(img, (5,5), 0.7)
+
+
+def _otsu_thresholds(hist: np.ndarray) -> np.ndarray:
+    # Row-wise Otsu threshold of 256-bin histograms, following cv.threshold with THRESH_OTSU:
+    # the first level maximizing the between-class variance, 0 if no split exists
+    levels = np.arange(hist.shape[1], dtype=np.float64)
+    total = hist.sum(axis=1, keepdims=True).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p = hist / total
+        q1 = np.cumsum(p, axis=1)
+        q2 = 1 - q1
+        m = np.cumsum(p * levels, axis=1)
+        mu1 = m / q1
+        mu2 = (m[:, -1:] - m) / q2
+        sigma = q1 * q2 * (mu1 - mu2) ** 2
+    eps = np.finfo(np.float32).eps
+    sigma[(np.minimum(q1, q2) < eps) | (np.maximum(q1, q2) > 1 - eps) | ~np.isfinite(sigma)] = 0
+    return np.argmax(sigma, axis=1).astype(np.float64)
+
+
+def _bboxes(label_image: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    # min_row, min_col, max_row, max_col of every label, max exclusive as in regionprops
+    boxes = ndimage.find_objects(label_image)
+    return np.array([(boxes[l - 1][0].start, boxes[l - 1][1].start, boxes[l - 1][0].stop, boxes[l - 1][1].stop)
+                     for l in labels], dtype=np.int32).reshape(-1, 4)
+
+
+def _bbox_areas(bboxes: np.ndarray) -> np.ndarray:
+    return ((bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])).astype(np.float64)
+
+
+def axis_lengths(moments: np.ndarray) -> np.ndarray:
+    """
+    Major and minor axis lengths, as columns, from the row variance, column variance and covariance
+    of every cell. These are the eigenvalues of the inertia tensor, as in RegionProperties.
+    """
+    var_r, var_c, cov = moments[:, 0], moments[:, 1], moments[:, 2]
+    half_sum = (var_r + var_c) / 2
+    root = np.sqrt(((var_r - var_c) / 2) ** 2 + cov ** 2)
+    ev_major = np.clip(half_sum + root, 0, None)
+    ev_minor = np.clip(half_sum - root, 0, None)
+    return np.stack([4 * np.sqrt(ev_major), 4 * np.sqrt(ev_minor)], axis=1)
+
+
+# Weights of the border pixel codes in skimage.measure.perimeter (4-connectivity)
+_PERIMETER_WEIGHTS = np.zeros(50, dtype=np.float64)
+_PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+_PERIMETER_WEIGHTS[[21, 33]] = np.sqrt(2)
+_PERIMETER_WEIGHTS[[13, 23]] = (1 + np.sqrt(2)) / 2
+
+
+def _shifted(img: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    # img[y + dy, x + dx] for every pixel of img, zero outside of it
+    padded = np.pad(img, 1)
+    return padded[1 + dy:1 + dy + img.shape[0], 1 + dx:1 + dx + img.shape[1]]
+
+
+def _label_perimeters(label_image: np.ndarray, n: int) -> np.ndarray:
+    # Same result as skimage.measure.perimeter on every region's image, in a single pass:
+    # a border pixel is coded by how many of its neighbours are border pixels of the same region
+    edges = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+    corners = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+    interior = label_image != 0
+    for dy, dx in edges:
+        interior &= _shifted(label_image, dy, dx) == label_image
+    border = np.where(interior, 0, label_image)
+    is_border = border != 0
+
+    code = np.ones(label_image.shape, dtype=np.intp)
+    for dy, dx in edges:
+        code += 2 * (_shifted(border, dy, dx) == border)
+    for dy, dx in corners:
+        code += 10 * (_shifted(border, dy, dx) == border)
+    return np.bincount(border[is_border], weights=_PERIMETER_WEIGHTS[code[is_border]], minlength=n)
+
+
+def geometry_table(label_image: np.ndarray, perimeter: bool = True) -> Dict[str, np.ndarray]:
+    """
+    Geometric properties of every label in label_image, ordered by label like regionprops, in pixel units.
+    Computed from label-indexed moment sums instead of per-region objects. moments are the row variance,
+    column variance and covariance of the cell's pixels, see axis_lengths.
+    """
+    label_image = np.asarray(label_image).astype(np.intp, copy=False)
+    flat = label_image.ravel()
+    idx = np.flatnonzero(flat)
+    labels = flat[idx]
+    n = int(labels.max()) + 1 if len(labels) > 0 else 1
+    rows, cols = np.divmod(idx, label_image.shape[1])
+
+    counts = np.bincount(labels, minlength=n).astype(np.float64)
+    present = np.flatnonzero(counts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_r = np.bincount(labels, rows, minlength=n) / counts
+        mean_c = np.bincount(labels, cols, minlength=n) / counts
+        dr = rows - mean_r[labels]
+        dc = cols - mean_c[labels]
+        var_r = np.bincount(labels, dr * dr, minlength=n) / counts
+        var_c = np.bincount(labels, dc * dc, minlength=n) / counts
+        cov = np.bincount(labels, dr * dc, minlength=n) / counts
+
+    table = {
+        "label": present,
+        "area": counts[present],
+        "centroid-0": mean_r[present],
+        "centroid-1": mean_c[present],
+        "moments": np.stack([var_r[present], var_c[present], cov[present]], axis=1),
+        "bbox": _bboxes(label_image, present),
+    }
+    if perimeter:
+        table["perimeter"] = _label_perimeters(label_image, n)[present]
+    return table
+
+
+def intensity_table(label_image: np.ndarray, channel_image: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Intensity properties of every label in label_image for a single channel, ordered by label.
+    Centers of mass come from label-indexed sums. Otsu thresholds are computed on the blurred crop of
+    every cell, as regionprops' image_intensity: the cell's pixels in its bounding box, zero elsewhere.
+    """
+    return intensity_tables(label_image, channel_image[:, :, np.newaxis], [0])[0]
+
+
+def _cell_crops(label_image: np.ndarray, channel_image: np.ndarray, labels: np.ndarray, bboxes: np.ndarray):
+    # Python ints index faster than numpy scalars
+    for label, (r0, c0, r1, c1) in zip(labels.tolist(), bboxes.tolist()):
+        crop = channel_image[r0:r1, c0:c1]
+        yield np.where(label_image[r0:r1, c0:c1] == label, crop, crop.dtype.type(0))
+
+
+def _crop_otsu_threshold(blurred: np.ndarray) -> float:
+    # cv.threshold only takes 8 and 16-bit images for Otsu, others are binned into 256 levels over [0, max]
+    if blurred.dtype in (np.uint8, np.uint16):
+        return cv.threshold(blurred, 0, 255, cv.THRESH_BINARY_INV | cv.THRESH_OTSU)[0]
+    top = float(blurred.max())
+    scale = top / (_INTENSITY_LEVELS - 1) if top > 0 else 1.0
+    levels = np.clip(blurred / scale, 0, _INTENSITY_LEVELS - 1).astype(np.intp)
+    return float(_otsu_thresholds(np.bincount(levels.ravel(), minlength=_INTENSITY_LEVELS)[np.newaxis])[0]) * scale
+
+
+def intensity_tables(label_image: np.ndarray, image: np.ndarray, channels: List[int],
+                     bboxes: Optional[np.ndarray] = None,
+                     stats: Sequence[str] = ("weighted_centroid", "otsu_threshold"),
+                     thresholds: Optional[Sequence[Optional[float]]] = None) -> List[Dict[str, np.ndarray]]:
+    """
+    intensity_table for several channels of a YXC image. The label index, bounding boxes and pixel
+    coordinates are computed once and shared by all channels. bboxes of the labels, as in geometry_table,
+    are found from the label image when not given. Only the given stats are computed, weighted centroids
+    from label-indexed sums, Otsu thresholds from the blurred crops which blurred_crops keeps, concatenated
+    in the order of the labels, to count the pixels above a threshold that is not known yet. Known
+    thresholds, one per channel or None, give filled_pixels, the pixels of every blurred crop above them.
+    """
+    # Crops are compared against labels in the mask's own, usually smaller, dtype
+    label_image = np.asarray(label_image)
+    flat = label_image.ravel()
+    present = np.flatnonzero(np.bincount(flat.astype(np.intp, copy=False)))
+    present = present[present > 0]
+    if "weighted_centroid" in stats:
+        idx = np.flatnonzero(flat)
+        labels = flat[idx].astype(np.intp)
+        n = int(present[-1]) + 1 if len(present) > 0 else 1
+        rows, cols = np.divmod(idx, label_image.shape[1])
+    thresholds = [None] * len(channels) if thresholds is None else thresholds
+    crops = "otsu_threshold" in stats or "blurred_crops" in stats or any(t is not None for t in thresholds)
+    if bboxes is None and crops:
+        bboxes = _bboxes(label_image, present)
+
+    tables = []
+    for channel, threshold in zip(channels, thresholds):
+        channel_image = image[:, :, channel]
+        table = {"label": present}
+        if "weighted_centroid" in stats:
+            weights = channel_image.ravel()[idx].astype(np.float64)
+            weight_sums = np.bincount(labels, weights, minlength=n)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                table["weighted_centroid-0"] = (np.bincount(labels, rows * weights, minlength=n) / weight_sums)[present]
+                table["weighted_centroid-1"] = (np.bincount(labels, cols * weights, minlength=n) / weight_sums)[present]
+        if crops:
+            # Every crop is blurred on its own, once, as the blur spreads the cell into the zeroed padding
+            # and is mirrored at the crop's border. This rules out blurring the whole image instead.
+            otsu_thresholds, filled, blurred_crops = [], [], []
+            for crop in _cell_crops(label_image, channel_image, present, bboxes):
+                blurred = _blur(crop)
+                if "otsu_threshold" in stats:
+                    otsu_thresholds.append(_crop_otsu_threshold(blurred))
+                if threshold is not None:
+                    filled.append(np.count_nonzero(blurred > threshold))
+                if "blurred_crops" in stats:
+                    blurred_crops.append(blurred.ravel())
+            if "otsu_threshold" in stats:
+                table["otsu_threshold"] = np.array(otsu_thresholds, dtype=np.float64)
+            if threshold is not None:
+                table["filled_pixels"] = np.array(filled, dtype=np.intp)
+            if "blurred_crops" in stats:
+                table["blurred_crops"] = np.concatenate(blurred_crops) if blurred_crops else np.array([])
+        tables.append(table)
+    return tables
+
+
+def count_above(blurred_crops: np.ndarray, bboxes: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Pixels above threshold in each of the concatenated blurred crops of intensity_tables.
+    """
+    above = np.concatenate([[0], np.cumsum(blurred_crops > threshold)])
+    ends = np.concatenate([[0], np.cumsum(_bbox_areas(bboxes).astype(np.intp))])
+    return np.diff(above[ends])
+
+
+class Feature(NamedTuple):
+    name: str
+    compute: Callable
+    depends: Tuple[str, ...]
+    # Output columns, none for features that are only used by others
+    columns: Tuple[str, ...]
+    per_channel: bool
+    # Keyword parameters compute accepts. With those of its dependencies they are part of the memoization key
+    params: Tuple[str, ...]
+
+
+# What the extractor provides to features, and whether it depends on the intensity channel:
+# cells - the per-cell struct of arrays (label, image, area, centroid, moments, bbox) in pixel units
+# pixel_perimeters - perimeters in pixels, only computed if a requested feature needs them
+# scales - the scale of every cell's image, or 1 if scales are not set
+# weighted_centroid - the intensity weighted centroid of every cell in a channel
+# otsu_threshold - the Otsu threshold of every cell's blurred crop in a channel
+# filled_pixels - pixels of every cell's blurred crop above a threshold, the mean Otsu threshold of all
+#   cells unless given, counted in another pass over the images once the threshold is known
+SOURCES = {"cells": False, "pixel_perimeters": False, "scales": False, "weighted_centroid": True,
+           "otsu_threshold": True, "filled_pixels": True}
+SOURCE_PARAMS = {"filled_pixels": ("threshold",)}
+
+FEATURES: Dict[str, Feature] = {}
+
+
+def register_feature(name: str, depends: Sequence[str] = (), columns: Optional[Sequence[str]] = None,
+                     params: Sequence[str] = ()):
+    """
+    Registers a feature computed by the decorated function from the values of its dependencies, given
+    positionally in order. Dependencies are other features or SOURCES. A feature depending on the
+    intensity channel, directly or through another feature, is computed and cached per channel.
+    A 1-d result is a single column, by default named as the feature, a 2-d result a column per given name.
+    With columns=[], the feature is not a column of its own and only serves other features.
+    """
+    def decorator(fn: Callable) -> Callable:
+        for dependency in depends:
+            if dependency not in FEATURES and dependency not in SOURCES:
+                raise ValueError(f"{name} depends on {dependency}, which is not a feature")
+        per_channel = any(SOURCES[d] if d in SOURCES else FEATURES[d].per_channel for d in depends)
+        FEATURES[name] = Feature(name, fn, tuple(depends), (name,) if columns is None else tuple(columns),
+                                 per_channel, tuple(params))
+        return fn
+    return decorator
+
+
+def feature_names(per_channel: bool) -> List[str]:
+    # Features with output columns, in registration order which is the order of the columns
+    return [f.name for f in FEATURES.values() if f.columns and f.per_channel == per_channel]
+
+
+def _accepted_params(name: str) -> Set[str]:
+    if name in SOURCES:
+        return set(SOURCE_PARAMS.get(name, ()))
+    feature = FEATURES[name]
+    return set(feature.params).union(*(_accepted_params(d) for d in feature.depends))
+
+
+def _dependencies(names: Sequence[str]) -> Set[str]:
+    closure, stack = set(), list(names)
+    while stack:
+        name = stack.pop()
+        if name not in closure:
+            closure.add(name)
+            if name in FEATURES:
+                stack.extend(FEATURES[name].depends)
+    return closure
+
+
+@register_feature("axis_lengths", ["cells"], columns=[])
+def _axis_lengths(cells):
+    return axis_lengths(cells["moments"])
+
+
+@register_feature("length", ["axis_lengths", "scales"])
+def _length(lengths, scales):
+    return lengths[:, 0] * scales
+
+
+@register_feature("width", ["axis_lengths", "scales"])
+def _width(lengths, scales):
+    return lengths[:, 1] * scales
+
+
+@register_feature("area", ["cells", "scales"])
+def _area(cells, scales):
+    return cells["area"].astype(np.float64) * (scales ** 2)
+
+
+@register_feature("centroid", ["cells"], columns=["centroidX", "centroidY"])
+def _centroid(cells):
+    return cells["centroid"]
+
+
+@register_feature("perimeter", ["pixel_perimeters", "scales"])
+def _perimeter(perimeters, scales):
+    return perimeters * scales
+
+
+@register_feature("aspect_ratio", ["axis_lengths"])
+def _aspect_ratio(lengths):
+    return lengths[:, 0] / lengths[:, 1]
+
+
+@register_feature("center_of_mass", ["weighted_centroid"], columns=["center_of_mass_X", "center_of_mass_Y"])
+def _center_of_mass(weighted_centroids):
+    return weighted_centroids
+
+
+@register_feature("d_com_centroid", ["centroid", "center_of_mass", "scales"])
+def _d_com_centroid(centroids, coms, scales):
+    distances = np.sqrt(((centroids[:,0] - coms[:,0]) ** 2) + ((centroids[:,1] - coms[:,1]) ** 2))
+    return distances * scales
+
+
+@register_feature("fraction_filled", ["filled_pixels", "cells"])
+def _fraction_filled(filled, cells):
+    return filled / _bbox_areas(cells["bbox"])
+
+
 class FeatureExtractor:
 
     ALL_GEOMETRICAL_FEATURES = ["length", "width", "area", "perimeter", "centroid", "aspect_ratio"]
+    ALL_INTENSITY_FEATURES = ["center_of_mass", "d_com_centroid", "fraction_filled"]
 
 
-    def __init__(self, masks: Union[List[np.ndarray], np.ndarray], files: List[str] = None,
-                                scales: Optional[np.ndarray] = None, unit=1e-6) -> None:
+    def __init__(self, masks: Union[List[np.ndarray], np.ndarray, Sequence, str], files: List[str] = None,
+                                scales: Optional[np.ndarray] = None, unit=1e-6,
+                                intensity_channels: Optional[List] = None,
+                                images: Optional[List[np.ndarray]] = None) -> None:
         
         if scales is None or len(scales) == 0:
             warnings.warn("scales not set, extracted features will be in pixels,"\
@@ -27,134 +367,340 @@ class FeatureExtractor:
         else:
             self.__files: List[str] = [files]
         
-        self.__regions: List[regionprops] = []
+        # Masks are only read when an image is processed, so stacks memory-mapped from .npy files or
+        # chunked on-disk arrays never have to fit in memory
+        self.__masks: Sequence = []
+        self.__cells: Optional[Dict[str, np.ndarray]] = None
+        # Per-cell intensity statistics by channel, see __scan_intensity
+        self.__intensity: Dict[object, Dict[object, np.ndarray]] = {}
+        self.__planned: Dict[object, Tuple[Set[str], Optional[float]]] = {}
+        # Results of get_feature by name, channel and parameters
+        self.__features: Dict[tuple, np.ndarray] = {}
+        self.__channel_indices: Dict[object, List[int]] = {}
+        # Already loaded intensity images (YXC) matching the masks, read from files otherwise. They are read
+        # again to count the pixels of cells above the fraction_filled threshold
+        self.__images: Optional[List[np.ndarray]] = images
+        # Channels whose intensity features are computed together, in one pass over the images
+        self.__intensity_channels: List = list(intensity_channels) if intensity_channels is not None else []
+        # A directory of masks saved by MaskStore, those of the given files in their order
+        if isinstance(masks, str):
+            masks = MaskStore(masks, self.__files)
         # Multiple images
-        if isinstance(masks, list) or (isinstance(masks, np.ndarray) and len(masks.shape) == 3):
-            for i in range(len(masks)):
-                img = io.load_image(files[i], 0, rgb=True, czi_all_channels=True) if files is not None else None
-                self.__regions.append(regionprops(masks[i], img))
+        if isinstance(masks, list):
+            self.__masks = list(masks)
+        elif isinstance(masks, MaskStore) or (isinstance(masks, np.ndarray) and len(masks.shape) == 3):
+            self.__masks = masks
         # Single image
         elif isinstance(masks, np.ndarray) and len(masks.shape) == 2:
-            img = io.load_image(files[0], 0, rgb=True, czi_all_channels=True) if files is not None else None
-            self.__regions.append(regionprops(masks, img))
-        
+            self.__masks = [masks]
+        # Other array-likes of 3 dimensions, such as zarr or dask arrays
+        elif len(getattr(masks, "shape", ())) == 3:
+            self.__masks = masks
+
         else:
-            if isinstance(masks, np.ndarray):
+            if isinstance(masks, np.ndarray) or hasattr(masks, "shape"):
                 error_message = "masks should be a 2-d array (single image) or a 3-d array (multiple images)."\
-                    f"Got: {masks.shape}"
+                    f"Got: {tuple(masks.shape)}"
                 raise ValueError(error_message)
             raise TypeError(f"Expected list or numpy array in masks. Got: {type(masks)}")
 
+
+    def __mask(self, i: int) -> np.ndarray:
+        return np.asarray(self.__masks[i])
         
+    def __get_cells(self, perimeter: bool = False) -> Dict[str, np.ndarray]:
+        # Struct of arrays with a row per cell of all images, filled in one pass over the masks. Nothing
+        # else is kept per cell, perimeters are only computed once they are asked for.
+        if self.__cells is None:
+            with profiling.stage("geometry", images=len(self.__masks), perimeter=perimeter):
+                tables = [geometry_table(self.__mask(i), perimeter) for i in range(len(self.__masks))]
+            counts = [len(t["label"]) for t in tables]
+            self.__cells = {
+                "image": np.repeat(np.arange(len(tables), dtype=np.uint32), counts),
+                "label": np.concatenate([t["label"] for t in tables]).astype(np.uint32),
+                "area": np.concatenate([t["area"] for t in tables]).astype(np.uint32),
+                "centroid": np.concatenate([np.stack([t["centroid-0"], t["centroid-1"]], axis=1) for t in tables]),
+                "moments": np.concatenate([t["moments"] for t in tables]),
+                "bbox": np.concatenate([t["bbox"] for t in tables]),
+            } if tables else {}
+            if perimeter and tables:
+                self.__cells["perimeter"] = np.concatenate([t["perimeter"] for t in tables])
+        elif perimeter and self.__cells and "perimeter" not in self.__cells:
+            with profiling.stage("geometry", images=len(self.__masks), perimeter=perimeter):
+                self.__cells["perimeter"] = np.concatenate([geometry_table(self.__mask(i))["perimeter"]
+                                                            for i in range(len(self.__masks))])
+        return self.__cells
+
+
+    def __get_cell_scales(self):
+        if isinstance(self.__scales, np.ndarray):
+            return self.__scales[self.__get_cells()["image"]]
+        return self.__scales
+
+
+    def __get_sources(self) -> np.ndarray:
+        images = self.__get_cells()["image"]
+        if self.__files is None:
+            return np.full(len(images), None, dtype=object)
+        return np.array(self.__files, dtype=object)[images]
+
+
+    def __get_source(self, name: str, channel, threshold: Optional[float] = None):
+        if name == "cells":
+            return self.__get_cells()
+        if name == "pixel_perimeters":
+            return self.__get_cells(perimeter=True)["perimeter"]
+        if name == "scales":
+            return self.__get_cell_scales()
+        if name == "filled_pixels":
+            return self.__count_filled(channel, threshold)
+        return self.__get_intensity(channel, name)
+
+
+    def get_feature(self, name: str, channel=None, **params):
+        """
+        A registered feature, or source, computed from its dependencies. Every result is cached per channel
+        and parameters for the lifetime of the extractor, and shared by all features depending on it.
+        Parameters are passed on to the dependencies that take them and ignored by the others.
+        """
+        if name not in FEATURES and name not in SOURCES:
+            raise ValueError(f"Unknown feature: {name}")
+        per_channel = SOURCES[name] if name in SOURCES else FEATURES[name].per_channel
+        if per_channel and channel is None:
+            raise ValueError(f"{name} is computed per intensity channel, but no channel was given")
+        params = {k: v for k, v in params.items() if k in _accepted_params(name)}
+        key = (name, channel if per_channel else None, tuple(sorted(params.items())))
+        if key not in self.__features:
+            if name in SOURCES:
+                value = self.__get_source(name, channel, **params)
+            else:
+                feature = FEATURES[name]
+                value = feature.compute(*[self.get_feature(d, channel, **params) for d in feature.depends],
+                                        **{k: v for k, v in params.items() if k in feature.params})
+            self.__features[key] = value
+        return self.__features[key]
+
+
     def get_lengths(self) -> np.ndarray:
-        lengths = np.array([np.array([cell.axis_major_length for cell in cells])
-                                        for cells in self.__regions], dtype=object)
-        return np.concatenate(lengths * self.__scales).ravel()
+        return self.get_feature("length")
 
 
     def get_widths(self) -> np.ndarray:
-        widths = np.array([np.array([cell.axis_minor_length for cell in cells])
-                                        for cells in self.__regions], dtype=object)
-        return np.concatenate(widths * self.__scales).ravel()
+        return self.get_feature("width")
 
     
     def get_areas(self) -> np.ndarray:
-        areas = np.array([np.array([cell.area for cell in cells])
-                                        for cells in self.__regions], dtype=object)
-        return np.concatenate(areas * (self.__scales ** 2)).ravel()
+        return self.get_feature("area")
 
 
     def get_perimeters(self) -> np.ndarray:
-        perimeters = np.array([np.array([cell.perimeter for cell in cells])
-                                        for cells in self.__regions], dtype=object)
-        return np.concatenate(perimeters * self.__scales).ravel()
+        return self.get_feature("perimeter")
 
     
     def get_centroids(self) -> np.ndarray:
-        return np.array([np.array(cell.centroid) for cells in self.__regions for cell in cells])
+        return self.get_feature("centroid")
 
     
     def get_aspect_ratios(self) -> np.ndarray:
-        return self.get_lengths() / self.get_widths()
+        return self.get_feature("aspect_ratio")
     
 
-    def __parse_channel(self, channel):
-        if isinstance(channel, str):
-            if self.__files is None or any(not f.endswith(".czi") for f in self.__files):
-                raise ValueError(f"String channels are only supported for .czi files. Got {self.__files}")
+    def __parse_channel(self, channel) -> List[int]:
+        if channel not in self.__channel_indices:
+            if isinstance(channel, str):
+                if self.__files is None or any(not f.endswith(".czi") for f in self.__files):
+                    raise ValueError(f"String channels are only supported for .czi files. Got {self.__files}")
+                self.__channel_indices[channel] = [io.get_czi_channel_index(f, channel) for f in self.__files]
+            else:
+                self.__channel_indices[channel] = [channel] * len(self.__masks)
+        return self.__channel_indices[channel]
+
+
+    def __image(self, i: int) -> np.ndarray:
+        if self.__images is not None:
+            img = self.__images[i]
+        else:
+            img = io.load_image(self.__files[i], 0, rgb=True, czi_all_channels=True)
+        return img[:, :, np.newaxis] if img.ndim == 2 else img
+
+
+    def __image_bboxes(self) -> List[Optional[np.ndarray]]:
+        # The bounding boxes of the cells of every image
+        cells = self.__get_cells()
+        if not cells:
+            return [None] * len(self.__masks)
+        return np.split(cells["bbox"], np.cumsum(np.bincount(cells["image"], minlength=len(self.__masks)))[:-1])
+
+
+    def __get_intensity(self, channel, stat: str) -> np.ndarray:
+        if stat not in self.__intensity.get(channel, {}):
+            self.__scan_intensity(channel, [stat])
+        return self.__intensity[channel][stat]
+
+
+    def __plan_intensity(self, channel, stats: Sequence[str], threshold: Optional[float] = None) -> None:
+        # Statistics computed in the next pass over the images, together with the one that is asked for.
+        # threshold is a fraction_filled threshold to count the pixels above.
+        planned, planned_threshold = self.__planned.get(channel, (set(), None))
+        self.__planned[channel] = (planned | set(stats), planned_threshold if threshold is None else threshold)
+
+
+    def __plan_features(self, channel, names: List[str], threshold: Optional[float]) -> None:
+        needed = _dependencies(names)
+        stats = [s for s in ("weighted_centroid", "otsu_threshold") if s in needed]
+        if "filled_pixels" in needed and threshold is None:
+            computed = self.__intensity.get(channel, {})
+            if "otsu_threshold" in computed:
+                threshold = computed["otsu_threshold"].mean()
             else:
-                channel_per_file = [io.get_czi_channel_index(f, channel) for f in self.__files]
-                channel = [channel_per_file[i] for i, cells in enumerate(self.__regions) for _ in cells]
-        return channel
+                stats += ["otsu_threshold", "blurred_crops"]
+        self.__plan_intensity(channel, stats, threshold if "filled_pixels" in needed else None)
+
+
+    def __scan_intensity(self, channel, stats: Sequence[str], threshold: Optional[float] = None) -> None:
+        # Every image is read once for all pending channels, and only the planned statistics are computed.
+        # The other intensity channels get the same statistics, but not the counts above this channel's threshold.
+        if self.__files is None and self.__images is None:
+            raise ValueError("Intensity features require the image files")
+        self.__plan_intensity(channel, stats, threshold)
+        for c in self.__intensity_channels:
+            if c != channel:
+                self.__plan_intensity(c, self.__planned[channel][0])
+        plans, self.__planned = self.__planned, {}
+        pending = []
+        for c, (planned, th) in plans.items():
+            computed = self.__intensity.get(c, {})
+            planned = sorted(s for s in planned if s not in computed)
+            th = None if ("filled_pixels", th) in computed else th
+            if planned or th is not None:
+                pending.append((c, planned, th))
+        pass_stats = sorted(set().union(*[planned for _, planned, _ in pending]))
+        # Bounding boxes are only needed for crops
+        crops = pass_stats != ["weighted_centroid"] or any(th is not None for _, _, th in pending)
+        bboxes = self.__image_bboxes() if crops else [None] * len(self.__masks)
+        channels = [self.__parse_channel(c) for c, _, _ in pending]
+        thresholds = [th for _, _, th in pending]
+        tables = [[] for _ in pending]
+        for i in range(len(self.__masks)):
+            mask, img = self.__mask(i), self.__image(i)
+            with profiling.stage("intensity", channels=len(pending), stats=pass_stats):
+                for j, table in enumerate(intensity_tables(mask, img, [c[i] for c in channels], bboxes[i],
+                                                           pass_stats, thresholds)):
+                    tables[j].append(table)
+            del mask, img
+        for (c, planned, th), channel_tables in zip(pending, tables):
+            intensity = self.__intensity.setdefault(c, {})
+            for stat in pass_stats:
+                if stat == "weighted_centroid":
+                    intensity[stat] = np.concatenate([np.stack([t["weighted_centroid-0"], t["weighted_centroid-1"]],
+                                                               axis=1) for t in channel_tables])
+                elif stat == "blurred_crops":
+                    # Per image, dropped once the pixels above the mean threshold are counted
+                    if stat in planned:
+                        intensity[stat] = [t[stat] for t in channel_tables]
+                else:
+                    intensity[stat] = np.concatenate([t[stat] for t in channel_tables])
+            if th is not None:
+                intensity[("filled_pixels", th)] = np.concatenate([t["filled_pixels"] for t in channel_tables])
+
+
+    def __count_filled(self, channel, threshold: Optional[float]) -> np.ndarray:
+        # The mean threshold is only known once every cell was seen. The crops blurred for the Otsu thresholds
+        # are kept until then, so every crop is blurred once. Otherwise they are blurred in another pass.
+        if threshold is None:
+            if "otsu_threshold" not in self.__intensity.get(channel, {}):
+                self.__scan_intensity(channel, ["otsu_threshold", "blurred_crops"])
+            threshold = self.get_feature("otsu_threshold", channel).mean()
+            blurred_crops = self.__intensity[channel].pop("blurred_crops", None)
+            if blurred_crops is not None:
+                with profiling.stage("fraction_filled"):
+                    counts = [count_above(b, boxes, threshold) for b, boxes in zip(blurred_crops,
+                                                                                  self.__image_bboxes())]
+                return np.concatenate(counts) if counts else np.array([], dtype=np.intp)
+        # Given thresholds are counted in the pass that computes the other planned statistics
+        if ("filled_pixels", threshold) not in self.__intensity.get(channel, {}):
+            self.__scan_intensity(channel, [], threshold)
+        return self.__intensity[channel].pop(("filled_pixels", threshold))
 
 
     def get_centers_of_mass(self, channel) -> np.ndarray:
-        data = np.array([np.array(cell.weighted_centroid) for cells in self.__regions for cell in cells])
-        return data[np.arange(len(data)),:,self.__parse_channel(channel)]
+        return self.get_feature("center_of_mass", channel)
     
 
     def get_delta_com_centroids(self, channel) -> np.ndarray:
-        centroids = self.get_centroids()
-        coms = self.get_centers_of_mass(channel)
+        return self.get_feature("d_com_centroid", channel)
 
-        distances = np.sqrt(((centroids[:,0] - coms[:,0]) ** 2) + ((centroids[:,1] - coms[:,1]) ** 2))
-        scales_vec = np.array([self.__scales[i] for i, cells in enumerate(self.__regions) for _ in cells])\
-            if isinstance(self.__scales, np.ndarray) else self.__scales
-        
-        return distances * scales_vec
 
+    def get_fraction_filled_thresholds(self, channel) -> np.ndarray:
+        return self.get_feature("otsu_threshold", channel)
 
-    def get_fraction_filled(self, channel) -> np.ndarray:
-        channels = self.__parse_channel(channel)
-        data = [cell.image_intensity for cells in self.__regions for cell in cells]
-        data = [d[:,:,channels[i]] for i, d in enumerate(data)]
 
-        def calc_threshold(img):
-            blurred = cv.GaussianBlur(img, (5,5), 0.7)
-            (T, _) = cv.threshold(blurred, 0, 255, cv.THRESH_BINARY_INV | cv.THRESH_OTSU)
-            return T
-        
-        th = np.array(list(map(calc_threshold, data))).mean()
+    def get_fraction_filled(self, channel, threshold: Optional[float] = None) -> np.ndarray:
+        return self.get_feature("fraction_filled", channel, threshold=threshold)
+
 
-        def calc_percentage(img):
-            blurred = cv.GaussianBlur(img, (5,5), 0.7)
-            (_, thresh) = cv.threshold(blurred, th, 255, cv.THRESH_BINARY)
-            return thresh[thresh > 0].size / thresh.size
-        return np.array(list(map(calc_percentage, data)))
+    @staticmethod
+    def __select(features: Optional[List[str]], per_channel: bool) -> List[str]:
+        available = feature_names(per_channel)
+        if features is None:
+            return available
+        unknown = [f for f in features if f not in available]
+        if unknown:
+            kind = "intensity" if per_channel else "geometrical"
+            raise ValueError(f"Unknown {kind} features: {unknown}. Available: {available}")
+        return [f for f in available if f in features]
+
+
+    def __columns(self, names: List[str], channel=None, **params) -> Dict[str, np.ndarray]:
+        res = {}
+        for name in names:
+            feature = FEATURES[name]
+            value = self.get_feature(name, channel, **params)
+            if value.ndim == 1:
+                res[feature.columns[0]] = value
+            else:
+                for i, column in enumerate(feature.columns):
+                    res[column] = value[:, i]
+        return res
 
     
     def get_geometrical_features(self, features: Optional[List[str]]) -> pd.DataFrame:
-        if features is None: features = FeatureExtractor.ALL_GEOMETRICAL_FEATURES
+        names = self.__select(features, per_channel=False)
+        # Perimeters are computed in the same pass over the masks as the rest of the geometry
+        self.__get_cells("pixel_perimeters" in _dependencies(names))
         res = {}
-
         if self.__files is not None:
-            res["source"] = [self.__files[i] for i, cells in enumerate(self.__regions) for _ in cells]
-        
-        if "length" in features:
-            res["length"] = self.get_lengths()
-        if "width" in features:
-            res["width"] = self.get_widths()
-        if "area" in features:
-            res["area"] = self.get_areas()
-        if "centroid" in features:
-            centroids = self.get_centroids().T
-            res["centroidX"] = centroids[0]
-            res["centroidY"] = centroids[1]
-        if "perimeter" in features:
-            res["perimeter"] = self.get_perimeters()
-        if "aspect_ratio" in features:
-            res["aspect_ratio"] = self.get_aspect_ratios()
-        
+            res["source"] = self.__get_sources()
+        res.update(self.__columns(names))
         return pd.DataFrame(res)
     
 
-    def get_intensity_features(self, channel, features: Optional[List[str]]) -> pd.DataFrame:
+    def get_intensity_features(self, channel, features: Optional[List[str]],
+                               fraction_threshold: Optional[Union[float, Dict]] = None) -> pd.DataFrame:
+        """
+        Intensity features of a channel, or of a list of channels as one wide table with the channel
+        appended to every column name. fraction_threshold may be given per channel as a dict.
+        """
+        if isinstance(channel, list):
+            for c in channel:
+                if c not in self.__intensity_channels:
+                    self.__intensity_channels.append(c)
+            thresholds = {c: fraction_threshold.get(c) if isinstance(fraction_threshold, dict) else fraction_threshold
+                          for c in channel}
+            # All channels are computed in the same pass over the images
+            for c in channel:
+                self.__plan_features(c, self.__select(features, per_channel=True), thresholds[c])
+            frames = []
+            for c in channel:
+                df = self.get_intensity_features(c, features, thresholds[c])
+                frames.append(df.drop(columns="source").add_suffix(f"_{c}"))
+            source = pd.DataFrame({"source": self.__get_sources()})
+            return pd.concat([source] + frames, axis=1)
+
+        names = self.__select(features, per_channel=True)
+        # Everything the features need from the images is computed in one pass over them
+        self.__plan_features(channel, names, fraction_threshold)
         res = {}
-        res["source"] = [self.__files[i] for i, cells in enumerate(self.__regions) for _ in cells]
-        coms = self.get_centers_of_mass(channel).T
-        res["center_of_mass_X"] = coms[0]
-        res["center_of_mass_Y"] = coms[1]
-        res["d_com_centroid"] = self.get_delta_com_centroids(channel)
-        res["fraction_filled"] = self.get_fraction_filled(channel)
+        res["source"] = self.__get_sources()
+        res.update(self.__columns(names, channel, threshold=fraction_threshold))
         return pd.DataFrame(res)
-
@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional
+
+PROFILE_FORMATS = ["json", "chrome"]
+
+_disabled = nullcontext()
+
+
+class Profiler:
+    """
+    Records timed stages and counters of a run. Stages are kept as complete events with the process
+    and thread they ran in, so runs with worker processes can be merged into a single trace.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter_ns()
+        self.events: List[dict] = []
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.__lock = threading.Lock()
+
+
+    @contextmanager
+    def stage(self, name: str, **args):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            event = {"name": name, "start_ns": start, "duration_ns": time.perf_counter_ns() - start,
+                     "pid": os.getpid(), "tid": threading.get_ident(), "args": args}
+            with self.__lock:
+                self.events.append(event)
+
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.__lock:
+            self.counters[name] += value
+
+
+    def drain(self) -> dict:
+        with self.__lock:
+            events, counters = self.events, dict(self.counters)
+            self.events, self.counters = [], defaultdict(float)
+        return {"events": events, "counters": counters}
+
+
+    def merge(self, recorded: dict) -> None:
+        with self.__lock:
+            self.events.extend(recorded["events"])
+            for name, value in recorded["counters"].items():
+                self.counters[name] += value
+
+
+    def summary(self) -> dict:
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event["name"], {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            seconds = event["duration_ns"] / 1e9
+            stage["count"] += 1
+            stage["total_seconds"] += seconds
+            stage["max_seconds"] = max(stage["max_seconds"], seconds)
+        for stage in stages.values():
+            stage["mean_seconds"] = stage["total_seconds"] / stage["count"]
+        return {"wall_seconds": (time.perf_counter_ns() - self.start) / 1e9,
+                "stages": dict(sorted(stages.items(), key=lambda s: -s[1]["total_seconds"])),
+                "counters": dict(self.counters)}
+
+
+    def chrome_trace(self) -> dict:
+        # Trace event format, opens in chrome://tracing and Perfetto. Timestamps are in microseconds.
+        trace = [{"name": e["name"], "cat": "cellstats", "ph": "X", "ts": (e["start_ns"] - self.start) / 1000,
+                  "dur": e["duration_ns"] / 1000, "pid": e["pid"], "tid": e["tid"], "args": e["args"]}
+                 for e in self.events]
+        end = (time.perf_counter_ns() - self.start) / 1000
+        trace.extend({"name": name, "ph": "C", "ts": end, "pid": os.getpid(), "args": {name: value}}
+                     for name, value in self.counters.items())
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+    def save(self, path: str, profile_format: str = "json") -> None:
+        if profile_format == "json":
+            data = {**self.summary(), "events": self.events}
+        elif profile_format == "chrome":
+            data = self.chrome_trace()
+        else:
+            raise ValueError(f"profile_format should be one of {PROFILE_FORMATS}. Got: {profile_format}")
+        with open(path, "w") as f:
+            json.dump(data, f, default=str)
+
+
+_profiler: Optional[Profiler] = None
+
+
+def get_profiler() -> Optional[Profiler]:
+    return _profiler
+
+
+def set_profiler(profiler: Optional[Profiler]) -> Optional[Profiler]:
+    global _profiler
+    previous, _profiler = _profiler, profiler
+    return previous
+
+
+def enabled() -> bool:
+    return _profiler is not None
+
+
+def stage(name: str, **args):
+    """
+    Times the enclosed block as a stage of the active profiler, does nothing when profiling is off.
+    """
+    if _profiler is None:
+        return _disabled
+    return _profiler.stage(name, **args)
+
+
+def count(name: str, value: float = 1) -> None:
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+def collect(fn, *args, **kwargs):
+    """
+    Runs fn with profiling on and returns its result together with what was recorded, to be merged
+    into the profiler of the process that submitted it.
+    """
+    if _profiler is None:
+        set_profiler(Profiler())
+    result = fn(*args, **kwargs)
+    return result, _profiler.drain()
+
+
+class Progress:
+    """
+    Progress bar on stderr with the processing rate and the estimated time left.
+    """
+
+    def __init__(self, total: int, unit: str = "images", label: str = "", width: int = 30, stream=None) -> None:
+        self.total = total
+        self.unit = unit
+        self.label = f"{label} " if label else ""
+        self.width = width
+        self.stream = stream if stream is not None else sys.stderr
+        self.done = 0
+        self.__start = time.perf_counter()
+        self.__render()
+
+
+    def update(self, n: int = 1) -> None:
+        self.done += n
+        self.__render()
+
+
+    def close(self) -> None:
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+    def __render(self) -> None:
+        elapsed = time.perf_counter() - self.__start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        filled = int(self.width * self.done / self.total) if self.total else self.width
+        if self.done >= self.total:
+            eta = f"done in {_format_duration(elapsed)}"
+        elif rate > 0:
+            eta = f"ETA {_format_duration((self.total - self.done) / rate)}"
+        else:
+            eta = "ETA --:--"
+        bar = f"[{'#' * filled}{'.' * (self.width - filled)}]"
+        self.stream.write(f"\r{self.label}{bar} {self.done}/{self.total} {self.unit} {rate:.2f} {self.unit}/s {eta}  ")
+        self.stream.flush()
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
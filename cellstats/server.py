@@ -0,0 +1,135 @@
+import os
+import io
+import sys
+import json
+import pathlib
+import socket
+import socketserver
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from typing import List, Optional
+
+# Only the standard library is imported at module level, so that clients start fast
+DEFAULT_SOCKET = pathlib.Path.home().joinpath('.cellstats', 'server.sock')
+
+
+class _ClientStream(io.TextIOBase):
+    """
+    Forwards everything a job prints to the client as it is written.
+    """
+
+    def __init__(self, wfile, name: str) -> None:
+        self.__wfile = wfile
+        self.__name = name
+
+
+    def writable(self) -> bool:
+        return True
+
+
+    def write(self, text: str) -> int:
+        if text:
+            _send(self.__wfile, {"stream": self.__name, "text": text})
+        return len(text)
+
+
+def _send(wfile, message: dict) -> None:
+    wfile.write(json.dumps(message).encode() + b"\n")
+    wfile.flush()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        try:
+            if request.get("command") == "ping":
+                from cellstats import models
+                loaded = models.get_model_pool().loaded()
+                _send(self.wfile, {"status": "ok", "models": [key[0] for key in loaded]})
+                return
+            if request.get("command") != "predict":
+                _send(self.wfile, {"status": "error", "error": "ValueError",
+                                   "message": f"Unknown command: {request.get('command')}"})
+                return
+            from cellstats import pipeline
+            with redirect_stdout(_ClientStream(self.wfile, "stdout")), \
+                    redirect_stderr(_ClientStream(self.wfile, "stderr")):
+                try:
+                    pipeline.run_job(request["job"])
+                except Exception as e:
+                    traceback.print_exc()
+                    _send(self.wfile, {"status": "error", "error": type(e).__name__, "message": str(e)})
+                    return
+            _send(self.wfile, {"status": "ok"})
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, the job's results are still written
+            pass
+
+
+def _is_running(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+    return True
+
+
+def serve(socket_path: Optional[str] = None, preload: Optional[List[str]] = None, use_gpu: bool = False) -> None:
+    """
+    Serves predict jobs on a unix socket, one at a time, keeping every model used by a job loaded.
+    """
+    from cellstats import models
+    socket_path = os.fspath(DEFAULT_SOCKET if socket_path is None else socket_path)
+    if os.path.exists(socket_path):
+        if _is_running(socket_path):
+            raise RuntimeError(f"A server is already listening on {socket_path}")
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+
+    models.set_model_pool(models.ModelPool())
+    for model_path in preload or []:
+        models.load_model(model_path, use_gpu)
+        print(f"Loaded {model_path}")
+    # Keep the expensive imports out of the first request as well
+    from cellstats import pipeline, tiling  # noqa: F401
+
+    with socketserver.UnixStreamServer(socket_path, _Handler) as server:
+        os.chmod(socket_path, 0o600)
+        print(f"Listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+
+def submit(socket_path: Optional[str], job: dict) -> bool:
+    """
+    Sends a job to a running server and relays its output. Returns whether the job succeeded.
+    """
+    socket_path = os.fspath(DEFAULT_SOCKET if socket_path is None else socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError) as e:
+            raise ConnectionError(f"No cellstats server is listening on {socket_path}. "\
+                                  "Start one with: cellstats serve") from e
+        s.sendall(json.dumps({"command": "predict", "job": job}).encode() + b"\n")
+        for line in s.makefile("rb"):
+            message = json.loads(line)
+            if "stream" in message:
+                stream = sys.stdout if message["stream"] == "stdout" else sys.stderr
+                stream.write(message["text"])
+                stream.flush()
+            elif message["status"] == "error":
+                print(f"{message['error']}: {message['message']}", file=sys.stderr)
+                return False
+            else:
+                return True
+    raise ConnectionError(f"The server on {socket_path} closed the connection before the job finished")
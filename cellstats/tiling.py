@@ -0,0 +1,202 @@
+import os
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+import numpy as np
+import pandas as pd
+from cellstats import io
+from cellstats import profiling
+from cellstats.cache import MaskCache
+from cellstats.output import check_output_path, closing_writers, open_writer
+from cellstats.pipeline import Segmenter, intensity_frames, intensity_output_path
+from cellstats.post_processing import FeatureExtractor, geometry_table
+
+DEFAULT_TILE_SIZE = 2048
+DEFAULT_TILE_OVERLAP = 128
+
+
+class Tile(NamedTuple):
+    # Cells whose centroid lies in the core belong to this tile. The tile is read and segmented
+    # with an overlap around the core, so those cells are whole. Both are y0, y1, x0, x1.
+    core: Tuple[int, int, int, int]
+    bounds: Tuple[int, int, int, int]
+
+
+def iter_tiles(shape: Tuple[int, int], tile_size: int, overlap: int) -> Iterator[Tile]:
+    height, width = shape
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+            yield Tile((y0, y1, x0, x1),
+                       (max(y0 - overlap, 0), min(y1 + overlap, height), max(x0 - overlap, 0), min(x1 + overlap, width)))
+
+
+def owned_cells(mask: np.ndarray, tile: Tile, shape: Tuple[int, int]) -> Tuple[np.ndarray, int]:
+    """
+    Keeps only the cells of a tile's mask whose centroid lies in the tile's core. Since the cores
+    partition the slide, every cell is reported by exactly one tile.
+    Returns the filtered mask and the number of kept cells that reach the tile's border inside the slide,
+    meaning they are larger than the overlap and were cut.
+    """
+    y0, y1, x0, x1 = tile.core
+    by0, by1, bx0, bx1 = tile.bounds
+    table = geometry_table(mask, perimeter=False)
+    cy = table["centroid-0"] + by0
+    cx = table["centroid-1"] + bx0
+    owned = table["label"][(cy >= y0) & (cy < y1) & (cx >= x0) & (cx < x1)]
+
+    keep = np.zeros(int(mask.max()) + 1, dtype=mask.dtype)
+    keep[owned] = owned
+    filtered = keep[mask]
+
+    edges = []
+    if by0 > 0:
+        edges.append(filtered[0])
+    if by1 < shape[0]:
+        edges.append(filtered[-1])
+    if bx0 > 0:
+        edges.append(filtered[:, 0])
+    if bx1 < shape[1]:
+        edges.append(filtered[:, -1])
+    cut = np.unique(np.concatenate(edges)) if edges else np.array([])
+    return filtered, int(np.count_nonzero(cut))
+
+
+def _offset(df: pd.DataFrame, dy: int, dx: int) -> pd.DataFrame:
+    # Tile coordinates to slide coordinates
+    for col in df.columns:
+        if col.startswith("centroidX") or col.startswith("center_of_mass_X"):
+            df[col] += dy
+        elif col.startswith("centroidY") or col.startswith("center_of_mass_Y"):
+            df[col] += dx
+    return df
+
+
+def _read_tile(lazy_image, tile: Tile, channel: Optional[int]) -> np.ndarray:
+    y0, y1, x0, x1 = tile.bounds
+    if channel is None:
+        return np.asarray(lazy_image[y0:y1, x0:x1, :].compute())
+    return np.asarray(lazy_image[y0:y1, x0:x1, channel].compute())
+
+
+def _segmentation_channel_index(img_path: str, channel) -> Optional[int]:
+    # The channel of the YXC image that is segmented, as in io.extract_channel: 0 is grayscale and k the
+    # k-th channel of other images, channels of CZI files are counted from 0. None if every channel is needed.
+    if img_path.endswith(".czi"):
+        return io.get_czi_channel_index(img_path, channel) if isinstance(channel, str) else channel
+    return None if channel == 0 or channel is None else channel - 1
+
+
+def _segmentation_image(img_path: str, img: np.ndarray, channel, index: Optional[int]) -> np.ndarray:
+    if img.ndim == 2:
+        # Only the segmented channel was read
+        return img
+    if index is None:
+        return io.extract_channel(img_path, img, channel)
+    return img[:, :, index]
+
+
+def predict_tiled(input_path: str, output_file: str, model_path: str, channel=0, use_gpu=False,
+                  features: Optional[List[str]] = None, intensity_channels: Optional[List] = None,
+                  tile_size: int = DEFAULT_TILE_SIZE, overlap: int = DEFAULT_TILE_OVERLAP, verbose=False,
+                  intensity_output: str = "separate", mask_cache: Optional[MaskCache] = None,
+                  output_format: str = "csv", eval_params: Optional[dict] = None, progress: bool = False) -> None:
+    """
+    Segments and extracts features from whole-slide images tile by tile, so memory use depends on
+    the tile size and not on the slide size. overlap should be larger than the largest cell diameter.
+    """
+    check_output_path(output_file, output_format)
+    image_paths, image_names = io.list_images(input_path)
+    intensity_channels = intensity_channels or []
+    segment = Segmenter(model_path, use_gpu, verbose, channel, eval_params, mask_cache)
+    wide = intensity_output == "wide"
+    if wide:
+        intensity_writers = {None: open_writer(intensity_output_path(output_file, None, output_format),
+                                               output_format)} if intensity_channels else {}
+    else:
+        intensity_writers = {ic: open_writer(intensity_output_path(output_file, ic, output_format), output_format)
+                             for ic in intensity_channels}
+    geometry_writer = open_writer(output_file, output_format)
+
+    lazy_images = [io.load_lazy_image(p) for p in image_paths]
+    seg_channels = [_segmentation_channel_index(p, channel) for p in image_paths]
+    run_scales = io.load_run_scales(image_paths)
+    scales = [run_scales[i:i + 1] for i in range(len(image_paths))] if len(run_scales) else \
+        [run_scales] * len(image_paths)
+    tiles = [(i, tile) for i, lazy in enumerate(lazy_images)
+             for tile in iter_tiles(lazy.shape[:2], tile_size, overlap)]
+
+    # As in pipeline.predict, fraction_filled thresholds are averaged over every cell, so with more than
+    # one tile the owned masks are spilled and intensity features are computed in a second pass
+    deferred = len(intensity_channels) > 0 and len(tiles) > 1
+    thresholds = {ic: [] for ic in intensity_channels}
+    cut_cells = 0
+
+    def read(k: int) -> np.ndarray:
+        i, tile = tiles[k]
+        with profiling.stage("read_tile", path=image_paths[i]):
+            return _read_tile(lazy_images[i], tile, None if intensity_channels else seg_channels[i])
+
+    with tempfile.TemporaryDirectory(prefix="cellstats_") as spill_dir, ThreadPoolExecutor(1) as reader, \
+            closing_writers([geometry_writer] + list(intensity_writers.values())):
+        # The next tile is read while the current one is segmented
+        progress_bar = profiling.Progress(len(tiles), "tiles") if progress else None
+        next_tile = reader.submit(read, 0) if tiles else None
+        for k, (i, tile) in enumerate(tiles):
+            img = next_tile.result()
+            next_tile = reader.submit(read, k + 1) if k + 1 < len(tiles) else None
+            if verbose:
+                print(f"{image_names[i]}: tile {tile.core}")
+
+            seg_image = _segmentation_image(image_paths[i], img, channel, seg_channels[i])
+            mask, cut = owned_cells(segment([np.ascontiguousarray(seg_image)])[0], tile, lazy_images[i].shape[:2])
+            cut_cells += cut
+            images = [img] if intensity_channels else None
+            fe = FeatureExtractor([mask], files=[image_paths[i]], scales=scales[i],
+                                  intensity_channels=intensity_channels, images=images)
+            dy, dx = tile.bounds[0], tile.bounds[2]
+            df = _offset(fe.get_geometrical_features(features), dy, dx)
+            df["source"] = image_names[i]
+            geometry_writer.write(df)
+
+            if deferred:
+                for ic in intensity_channels:
+                    thresholds[ic].append(fe.get_fraction_filled_thresholds(ic))
+                np.savez_compressed(os.path.join(spill_dir, f"{k}.npz"), mask=mask)
+            else:
+                for key, df in intensity_frames(fe, intensity_channels, wide).items():
+                    df = _offset(df, dy, dx)
+                    df["source"] = image_names[i]
+                    intensity_writers[key].write(df)
+            del fe, img, mask
+            if progress_bar is not None:
+                progress_bar.update()
+        if progress_bar is not None:
+            progress_bar.close()
+
+        if deferred:
+            thresholds = {ic: np.concatenate(th).mean() for ic, th in thresholds.items()}
+            progress_bar = profiling.Progress(len(tiles), "tiles", "intensity") if progress else None
+            next_tile = reader.submit(read, 0)
+            for k, (i, tile) in enumerate(tiles):
+                img = next_tile.result()
+                next_tile = reader.submit(read, k + 1) if k + 1 < len(tiles) else None
+                with np.load(os.path.join(spill_dir, f"{k}.npz")) as data:
+                    mask = data["mask"]
+                fe = FeatureExtractor([mask], files=[image_paths[i]], scales=scales[i],
+                                      intensity_channels=intensity_channels, images=[img])
+                dy, dx = tile.bounds[0], tile.bounds[2]
+                for key, df in intensity_frames(fe, intensity_channels, wide, thresholds).items():
+                    df = _offset(df, dy, dx)
+                    df["source"] = image_names[i]
+                    intensity_writers[key].write(df)
+                del fe, img, mask
+                if progress_bar is not None:
+                    progress_bar.update()
+            if progress_bar is not None:
+                progress_bar.close()
+
+    if cut_cells > 0:
+        warnings.warn(f"{cut_cells} cells reached a tile border and were cut, "\
+                      "consider a tile overlap larger than the largest cell")
@@ -9,8 +9,9 @@ setup(name='cellstats',
       author='Noam Blum',
       author_email='noam.blum1@mail.huji.ac.il',
       license='BSD',
-      packages=['cellstats'],
+      packages=['cellstats', 'cellstats.benchmarks'],
       install_requires=install_deps,
+      extras_require={'arrow': ['pyarrow']},
       zip_safe=False,
       entry_points = {
         'console_scripts': [
@@ -0,0 +1,90 @@
+import os
+import shutil
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+from cellstats import models, pipeline
+from cellstats.benchmarks.stages import ThresholdModel
+
+
+@pytest.fixture
+def model_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(models, "load_model", lambda *args, **kwargs: ThresholdModel())
+    path = tmp_path / "model"
+    path.write_bytes(b"weights")
+    return str(path)
+
+
+def _save_image(path: str, seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    img = (rng.random((64, 80, 3)) * 40).astype(np.uint8)
+    yy, xx = np.mgrid[:64, :80]
+    for _ in range(6):
+        cy, cx, r = rng.integers(8, 56), rng.integers(8, 72), rng.integers(3, 7)
+        img[(yy - cy) ** 2 + (xx - cx) ** 2 < r * r] += rng.integers(80, 200, 3).astype(np.uint8)
+    Image.fromarray(img).save(path)
+
+
+def _run(input_dir: str, output_file: str, model_path: str) -> pd.DataFrame:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        pipeline.predict(input_dir, output_file, model_path, 0, intensity_channels=[1], chunk_size=1,
+                         incremental=True)
+    # Incremental runs append new files at the end, so rows are compared per file
+    return pd.concat([pd.read_csv(output_file), pd.read_csv(output_file.replace(".csv", "_intensity_1.csv"))],
+                     axis=1, keys=["geometry", "intensity"]) \
+        .sort_values(("geometry", "source"), kind="stable").reset_index(drop=True)
+
+
+def _assert_fresh(input_dir: str, output_file: str, model_path: str, tmp_path) -> None:
+    resumed = _run(input_dir, output_file, model_path)
+    # Incremental runs threshold fraction_filled per chunk, so the fresh run is one without a manifest yet
+    fresh = _run(input_dir, str(tmp_path / "fresh.csv"), model_path)
+    pd.testing.assert_frame_equal(resumed, fresh)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for i in range(3):
+        _save_image(str(input_dir / f"img{i}.png"), i)
+    return str(input_dir)
+
+
+def test_new_file(tmp_path, model_path, inputs):
+    output_file = str(tmp_path / "out.csv")
+    _run(inputs, output_file, model_path)
+    _save_image(os.path.join(inputs, "img3.png"), 3)
+    _assert_fresh(inputs, output_file, model_path, tmp_path)
+
+
+def test_changed_file(tmp_path, model_path, inputs):
+    output_file = str(tmp_path / "out.csv")
+    before = _run(inputs, output_file, model_path)
+    path = os.path.join(inputs, "img1.png")
+    _save_image(path, 10)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    _assert_fresh(inputs, output_file, model_path, tmp_path)
+    assert not _run(inputs, output_file, model_path).equals(before)
+
+
+def test_interrupted_chunk(tmp_path, model_path, inputs):
+    output_file = str(tmp_path / "out.csv")
+    outputs = [output_file, output_file.replace(".csv", "_intensity_1.csv")]
+    os.rename(os.path.join(inputs, "img2.png"), str(tmp_path / "img2.png"))
+    _run(inputs, output_file, model_path)
+    manifest = output_file + ".manifest.json"
+    shutil.copy(manifest, str(tmp_path / "manifest.json"))
+    # The rows of the next chunk are written, then the run stops before the manifest is saved,
+    # halfway through a row of the following chunk
+    os.rename(str(tmp_path / "img2.png"), os.path.join(inputs, "img2.png"))
+    _run(inputs, output_file, model_path)
+    shutil.copy(str(tmp_path / "manifest.json"), manifest)
+    for output in outputs:
+        with open(output, "a") as f:
+            f.write(os.path.join(inputs, "img3.png") + ",12")
+    _assert_fresh(inputs, output_file, model_path, tmp_path)
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+from cellstats.output import open_writer
+
+pytest.importorskip("pyarrow")
+
+
+def _read(path: str, output_format: str) -> pd.DataFrame:
+    return pd.read_parquet(path) if output_format == "parquet" else pd.read_feather(path)
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_first_chunk_without_cells(tmp_path, output_format):
+    # The first image of a run, or the first tile of a slide, often has no cells
+    chunks = [pd.DataFrame({"source": pd.Series([], dtype=object), "area": np.array([], dtype=float),
+                            "perimeter": np.array([], dtype=np.int64)}),
+              pd.DataFrame({"source": ["a.tif", "a.tif"], "area": [1.0, 2.0], "perimeter": [4, 6]}),
+              pd.DataFrame({"source": [f"{i}.tif" for i in range(300)], "area": np.ones(300),
+                            "perimeter": np.ones(300, dtype=np.int64)})]
+    path = str(tmp_path / f"out.{output_format}")
+    writer = open_writer(path, output_format)
+    for df in chunks:
+        writer.write(df)
+    writer.close()
+
+    result = _read(path, output_format)
+    expected = pd.concat(chunks[1:], ignore_index=True)
+    assert list(result["source"].astype(str)) == list(expected["source"])
+    np.testing.assert_array_equal(result["area"], expected["area"])
+    np.testing.assert_array_equal(result["perimeter"], expected["perimeter"])
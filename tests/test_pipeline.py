@@ -0,0 +1,35 @@
+import numpy as np
+from cellstats.benchmarks.stages import ThresholdModel
+from cellstats.pipeline import Segmenter
+
+
+def _threshold_model(model_path, use_gpu, verbose=False, device=None):
+    # Module level, so that spawned workers can load it
+    return ThresholdModel()
+
+
+def _images(n: int):
+    # A different number of cells in every image, so that masks out of order don't match
+    images = []
+    for i in range(n):
+        img = np.zeros((32, 40), dtype=np.uint8)
+        for k in range(i + 1):
+            img[2 + 6 * (k // 5):6 + 6 * (k // 5), 2 + 8 * (k % 5):7 + 8 * (k % 5)] = 200
+        images.append(img)
+    return images
+
+
+def test_sharded_masks_in_input_order(tmp_path):
+    model_path = tmp_path / "model"
+    model_path.write_bytes(b"weights")
+    images = _images(5)
+    expected = Segmenter(str(model_path), model_factory=_threshold_model)(images)
+    segment = Segmenter(str(model_path), workers=2, devices=["cpu", "cpu"], model_factory=_threshold_model)
+    try:
+        masks = segment(images)
+    finally:
+        segment.close()
+    assert [int(m.max()) for m in expected] == [1, 2, 3, 4, 5]
+    assert len(masks) == len(images)
+    for mask, exp in zip(masks, expected):
+        np.testing.assert_array_equal(mask, exp)
@@ -0,0 +1,113 @@
+import warnings
+import cv2 as cv
+import numpy as np
+import pytest
+from skimage.measure import regionprops
+from cellstats.masks import MaskStore
+from cellstats.post_processing import FeatureExtractor, axis_lengths, geometry_table, intensity_table
+
+
+def _label_image() -> np.ndarray:
+    # Touching cells, a cell at the image border and one inside another's bounding box
+    labels = np.zeros((40, 48), dtype=np.int32)
+    yy, xx = np.mgrid[:40, :48]
+    labels[(yy - 12) ** 2 + (xx - 12) ** 2 < 64] = 1
+    labels[(yy - 14) ** 2 + ((xx - 24) / 1.5) ** 2 < 49] = 2
+    labels[30:40, 0:9] = 3
+    labels[22:36, 28:46] = 4
+    labels[27:31, 33:39] = 5
+    return labels
+
+
+def _intensity_image(labels: np.ndarray, dtype=np.uint8) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    top = np.iinfo(dtype).max
+    image = rng.integers(0, top // 10, labels.shape)
+    image = image + (labels > 0) * rng.integers(top // 4, top // 2, labels.shape)
+    return image.astype(dtype)
+
+
+def _crop_reference(labels: np.ndarray, image: np.ndarray):
+    # The original per-cell computation on regionprops crops
+    thresholds, crops = [], []
+    for region in regionprops(labels, image):
+        blurred = cv.GaussianBlur(region.image_intensity, (5, 5), 0.7)
+        thresholds.append(cv.threshold(blurred, 0, 255, cv.THRESH_BINARY_INV | cv.THRESH_OTSU)[0])
+        crops.append(blurred)
+    mean = np.mean(thresholds)
+    filled = [np.count_nonzero(b > mean) / b.size for b in crops]
+    return np.array(thresholds), np.array(filled)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_intensity_matches_regionprops_crops(dtype):
+    labels = _label_image()
+    image = _intensity_image(labels, dtype)
+    thresholds, filled = _crop_reference(labels, image)
+
+    table = intensity_table(labels, image)
+    np.testing.assert_array_equal(table["otsu_threshold"], thresholds)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        fe = FeatureExtractor(labels, images=[image[:, :, np.newaxis]])
+        # Pixels are counted on the crops blurred for the thresholds, or on crops blurred again once the
+        # thresholds were already computed
+        fresh = FeatureExtractor(labels, images=[image[:, :, np.newaxis]])
+        # The threshold of a run's second pass is given
+        given = FeatureExtractor(labels, images=[image[:, :, np.newaxis]])
+    np.testing.assert_array_equal(fresh.get_fraction_filled(0), filled)
+    np.testing.assert_array_equal(given.get_intensity_features(0, None, thresholds.mean())["fraction_filled"], filled)
+    np.testing.assert_array_equal(fe.get_fraction_filled_thresholds(0), thresholds)
+    np.testing.assert_array_equal(fe.get_fraction_filled(0), filled)
+    # The threshold depends on intensity, not only on the shape of the cells
+    areas = np.array([r.area / r.area_bbox for r in regionprops(labels)])
+    assert not np.allclose(fe.get_fraction_filled(0), areas)
+
+
+def test_geometry_matches_regionprops():
+    labels = _label_image()
+    # Gaps between labels, a single pixel cell and a line along the border
+    labels = np.array([0, 2, 3, 7, 8, 12])[labels]
+    labels[0, 40] = 15
+    labels[0:12, 47] = 16
+    table = geometry_table(labels)
+    regions = regionprops(labels)
+
+    np.testing.assert_array_equal(table["label"], [r.label for r in regions])
+    np.testing.assert_array_equal(table["area"], [r.area for r in regions])
+    np.testing.assert_array_equal(table["bbox"], [r.bbox for r in regions])
+    np.testing.assert_allclose(table["centroid-0"], [r.centroid[0] for r in regions], rtol=0, atol=1e-13)
+    np.testing.assert_allclose(table["centroid-1"], [r.centroid[1] for r in regions], rtol=0, atol=1e-13)
+    np.testing.assert_allclose(table["perimeter"], [r.perimeter for r in regions], rtol=0, atol=1e-13)
+    np.testing.assert_allclose(axis_lengths(table["moments"]),
+                               [(r.axis_major_length, r.axis_minor_length) for r in regions], rtol=0, atol=1e-12)
+    # Row variance, column variance and covariance are the inertia tensor of regionprops
+    np.testing.assert_allclose(table["moments"],
+                               [(r.inertia_tensor[1, 1], r.inertia_tensor[0, 0], -r.inertia_tensor[0, 1])
+                                for r in regions], rtol=0, atol=1e-12)
+
+
+def test_centers_of_mass_match_regionprops():
+    labels = _label_image()
+    image = _intensity_image(labels)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        fe = FeatureExtractor(labels, images=[image[:, :, np.newaxis]])
+    expected = np.array([r.centroid_weighted for r in regionprops(labels, image)])
+    np.testing.assert_allclose(fe.get_centers_of_mass(0), expected)
+
+
+def test_mask_directory_follows_files(tmp_path):
+    labels = _label_image()
+    store = MaskStore(str(tmp_path), [])
+    store.extend(["b.tif", "a.tif"], [labels, labels[:, :20]])
+    files = [str(tmp_path / "in" / "b.tif"), str(tmp_path / "in" / "a.tif")]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        fe = FeatureExtractor(str(tmp_path), files=files)
+        areas = fe.get_geometrical_features(["area"])
+        with pytest.raises(FileNotFoundError):
+            FeatureExtractor(str(tmp_path), files=files + [str(tmp_path / "in" / "c.tif")])
+    # Masks are matched to the files by name, not by their order in the directory
+    assert list(areas["source"]) == [files[0]] * 5 + [files[1]] * 3